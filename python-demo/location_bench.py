@@ -0,0 +1,308 @@
+"""
+Benchmarks for the location analysis pipeline.
+
+Synthetic location data is generated with a seeded mobility model, where
+each user has a home, a workplace and a few other places, spends the night at
+home, commutes on weekdays and sometimes visits other places in the evening.
+Samples are taken at a fixed rate with GPS noise.
+
+Every stage of location.py is timed for each combination of number of users,
+number of days and sampling rate, and the results are written as JSON so runs
+from different commits can be compared:
+
+    python location_bench.py --users 1 10 --days 1 7 --sampling 60 300 -o new.json
+    python location_bench.py --compare old.json new.json
+
+The time to import location.py in a fresh interpreter is measured as well, and
+--import-budget fails the run if it is exceeded or heavy optional dependencies
+are imported up front. test_location.py checks the same budget when the tests
+run with python -m pytest.
+"""
+
+import argparse
+from collections import defaultdict
+from contextlib import contextmanager
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import location
+
+
+STAGES = ['preprocess', 'get_stops', 'merge_stops', 'get_places', 'get_moves',
+          'radius_of_gyration', 'std_of_displacements', 'log_variance', 'entropy',
+          'home_stay', 'hours_of_day', 'routine_index']
+# modules that should only be imported by the functions that need them
+LAZY_MODULES = ['geopy', 'scipy', 'sklearn', 'numba']
+START_DATE = '2020-04-22'  # first day of the study
+CENTER = (55.6761, 12.5683)  # Copenhagen
+METERS_PER_DEGREE = 111320.0
+
+
+# synthetic data
+
+def synthetic_points(n_users=1, n_days=1, sampling=60, noise=5, seed=0):
+    """
+    Generate synthetic location data.
+
+    :param n_users: number of users.
+    :param n_days: number of days per user.
+    :param sampling: seconds between location samples.
+    :param noise: standard deviation of GPS noise in meters.
+    :param seed: random seed, the same seed generates the same data.
+    :return: dataframe of location points with columns: user_id, timestamp, latitude, longitude.
+    """
+    rng = np.random.RandomState(seed)
+    users = [_synthetic_user(u, n_days, sampling, noise, rng) for u in range(n_users)]
+    return pd.concat(users, ignore_index=True)
+
+
+def _synthetic_user(user_id, n_days, sampling, noise, rng):
+    """Generate location data for one user."""
+    home, work = _random_place(rng, 5000), _random_place(rng, 10000)
+    others = [_random_place(rng, 10000) for _ in range(3)]
+    start = pd.Timestamp(START_DATE).value // 10**9
+    times, positions = [], []
+    for day in range(n_days):
+        midnight = start + day * 86400
+        weekday = pd.Timestamp(midnight, unit='s').dayofweek < 5
+        t, p = _synthetic_day(home, work if weekday else None, others, rng)
+        times.append(midnight + t)
+        positions.append(p)
+    # waypoints of the day are interpolated at the sample times
+    times, positions = np.concatenate(times), np.concatenate(positions)
+    ts = np.arange(start, start + n_days * 86400, sampling, dtype=float)
+    ts += rng.uniform(0, min(sampling, 60) / 10.0, len(ts))
+    lat = np.interp(ts, times, positions[:, 0])
+    lon = np.interp(ts, times, positions[:, 1])
+    lat += rng.normal(0, noise, len(ts)) / METERS_PER_DEGREE
+    lon += rng.normal(0, noise, len(ts)) / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+    return pd.DataFrame({'user_id': user_id, 'timestamp': np.round(ts * 1000),
+                         'latitude': lat, 'longitude': lon})
+
+
+def _synthetic_day(home, work, others, rng):
+    """
+    Generate waypoints of one day as seconds since midnight and positions.
+
+    A stay is two waypoints at the same position and travel is interpolated
+    between the stays.
+    """
+    schedule = []  # (arrival hour, departure hour, position)
+    t = 0.0
+    if work is not None:
+        leave = rng.uniform(7, 9)
+        schedule.append((t, leave, home))
+        t = leave + rng.uniform(0.3, 0.7)
+        leave = rng.uniform(15.5, 17.5)
+        schedule.append((t, leave, work))
+        t = leave + rng.uniform(0.3, 0.7)
+    if rng.uniform() < 0.5:
+        leave = t + rng.uniform(1, 3) if t > 0 else rng.uniform(10, 14)
+        schedule.append((t, leave, home))
+        t = leave + rng.uniform(0.1, 0.4)
+        leave = t + rng.uniform(1, 2.5)
+        schedule.append((t, leave, others[rng.randint(len(others))]))
+        t = leave + rng.uniform(0.1, 0.4)
+    schedule.append((t, 24.0, home))
+    times = np.array([h * 3600 for a, d, _ in schedule for h in (a, d)])
+    positions = np.array([p for _, _, p in schedule for _ in range(2)])
+    return times, positions
+
+
+def _random_place(rng, radius):
+    """Random position within radius meters of the center."""
+    r, a = radius * np.sqrt(rng.uniform()), rng.uniform(0, 2 * np.pi)
+    return (CENTER[0] + r * np.sin(a) / METERS_PER_DEGREE,
+            CENTER[1] + r * np.cos(a) / (METERS_PER_DEGREE * np.cos(np.radians(CENTER[0]))))
+
+
+# benchmarks
+
+@contextmanager
+def _timed(timings, stage):
+    t = time.perf_counter()
+    yield
+    timings[stage] += time.perf_counter() - t
+
+
+def benchmark_pipeline(df, stop_duration=15, stop_dist=25, place_dist=25, move_duration=5,
+                       move_dist=50, merge_dist=25, merge_time=5,
+                       distf=location.haversine_distance):
+    """
+    Time every stage of the location pipeline on raw location data.
+
+    :param df: dataframe of location points as returned by synthetic_points.
+    :param distf: distance function passed to every stage.
+    :return: dict of stage --> seconds.
+    """
+    timings = defaultdict(float)
+    with _timed(timings, 'preprocess'):
+        df = location.preprocess(df)
+    df = df.rename(columns={'latitude': 'lat', 'longitude': 'lon'})
+    all_stops = []
+    for user_id, points in df.groupby('user_id'):
+        days = [d for _, d in points.groupby('date')]
+        with _timed(timings, 'get_stops'):
+            stops = [location.get_stops(d, stop_duration, stop_dist, distf) for d in days]
+        with _timed(timings, 'merge_stops'):
+            stops = [location.merge_stops(s, merge_dist, merge_time, distf) for s in stops]
+        for d, s in zip(days, stops):
+            s.insert(1, 'date', d.date.values[0])
+        stops = pd.concat(stops, ignore_index=True)
+        with _timed(timings, 'get_places'):
+            stops, places = location.get_places(stops, place_dist, distf)
+        with _timed(timings, 'get_moves'):
+            for d in days:
+                location.get_moves(d, stops, move_duration, move_dist, distf)
+        stops = stops.rename(columns={'lat': 'latitude', 'lon': 'longitude'})
+        # days without stops get an empty frame of stops
+        day_stops = [stops[stops.date == d.date.values[0]] for d in days]
+        day_points = [d.rename(columns={'lat': 'latitude', 'lon': 'longitude'}) for d in days]
+        with _timed(timings, 'radius_of_gyration'):
+            for s in day_stops:
+                location.radius_of_gyration(s, distf)
+        with _timed(timings, 'std_of_displacements'):
+            for s in day_stops:
+                location.std_of_displacements(s, distf)
+        with _timed(timings, 'log_variance'):
+            for d in day_points:
+                location.log_variance(d)
+        with _timed(timings, 'entropy'):
+            for s in day_stops:
+                location.entropy(s)
+        with _timed(timings, 'home_stay'):
+            if not stops.empty:
+                location.home_stay(stops)
+        with _timed(timings, 'hours_of_day'):
+            location.get_time_spent_at_place_hours_of_day(stops)
+        all_stops.append(stops)
+    stops = pd.concat(all_stops, ignore_index=True)
+    with _timed(timings, 'routine_index'):
+        if not stops.empty:
+            location.get_routine_indices(stops)
+    return dict(timings)
+
+
+def run(users=(1,), days=(1,), sampling=(60,), seed=0, distf=location.haversine_distance,
+        verbose=False):
+    """
+    Run the pipeline benchmark for every combination of sizes.
+
+    :param users: numbers of users.
+    :param days: numbers of days per user.
+    :param sampling: seconds between location samples.
+    :param seed: random seed of the synthetic data.
+    :param distf: distance function passed to every stage.
+    :return: list of result dicts with one entry per stage and size.
+    """
+    results = []
+    for n_users in users:
+        for n_days in days:
+            for rate in sampling:
+                df = synthetic_points(n_users, n_days, rate, seed=seed)
+                timings = benchmark_pipeline(df, distf=distf)
+                for stage in STAGES:
+                    results.append({'stage': stage, 'users': n_users, 'days': n_days,
+                                    'sampling': rate, 'points': len(df),
+                                    'seconds': timings.get(stage, 0.0)})
+                    if verbose:
+                        print('%-14s users=%-6d days=%-4d sampling=%-4d %10.4f s'
+                              % (stage, n_users, n_days, rate, results[-1]['seconds']))
+    return results
+
+
+def import_time(module='location', repeat=5):
+    """
+    Measure the time to import a module in a fresh interpreter.
+
+    :param module: name of the module to import.
+    :param repeat: number of interpreters started, the fastest import is reported.
+    :return: tuple of seconds and list of LAZY_MODULES imported with the module.
+    """
+    code = ('import json, sys, time; t = time.perf_counter(); import %s; '
+            't = time.perf_counter() - t; '
+            'print(json.dumps([t, [m for m in %r if m in sys.modules]]))') % (module, LAZY_MODULES)
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = [json.loads(subprocess.check_output([sys.executable, '-c', code], cwd=cwd))
+               for _ in range(repeat)]
+    return min(t for t, _ in results), results[0][1]
+
+
+def compare(old, new):
+    """
+    Compare two benchmark result files.
+
+    :param old: result dict of the baseline run.
+    :param new: result dict of the new run.
+    :return: dataframe with seconds of both runs and the speedup for each stage and size.
+    """
+    keys = ['stage', 'users', 'days', 'sampling']
+    res = pd.merge(pd.DataFrame(old['results']), pd.DataFrame(new['results']),
+                   on=keys, suffixes=('_old', '_new'))
+    res['speedup'] = res.seconds_old / res.seconds_new
+    return res[keys + ['seconds_old', 'seconds_new', 'speedup']]
+
+
+def _commit():
+    """Current git commit, or None outside a git repository."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the location analysis pipeline.')
+    parser.add_argument('--users', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--days', type=int, nargs='+', default=[1, 7])
+    parser.add_argument('--sampling', type=int, nargs='+', default=[60, 300],
+                        help='seconds between location samples')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--distf', choices=['haversine', 'geodesic'], default='haversine')
+    parser.add_argument('-o', '--output', help='write results as JSON to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running benchmarks')
+    parser.add_argument('--import-budget', type=float, metavar='SECONDS',
+                        help='fail if importing location takes longer or imports %s'
+                        % ', '.join(LAZY_MODULES))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            print(compare(json.load(f_old), json.load(f_new)).to_string(index=False))
+        return
+
+    seconds, modules = import_time()
+    print('import location %.4f s, lazy modules imported: %s' % (seconds, modules or 'none'))
+    if args.import_budget is not None and (seconds > args.import_budget or modules):
+        sys.exit('import budget of %.4f s exceeded' % args.import_budget)
+
+    distf = location.haversine_distance if args.distf == 'haversine' \
+        else location.geodesic_distance
+    output = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'distf': args.distf,
+        'seed': args.seed,
+        'import': {'seconds': seconds, 'modules': modules},
+        'results': run(args.users, args.days, args.sampling, args.seed, distf, verbose=True),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
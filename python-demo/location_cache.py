@@ -0,0 +1,263 @@
+"""
+Content-addressed result cache for the stops, places and moves pipeline.
+
+Results are keyed by a hash of the input location points and the parameters
+of a pipeline stage. Recent results are kept in memory in least recently used
+order up to a size in bytes and, if a directory is given, also pickled to disk
+so they survive the process.
+
+The daily pipeline keys the stops and moves of each day by a digest of the
+points of the day, so it only recomputes days whose points changed. Reruns
+over a long history need a directory, or a memory limit large enough for the
+results of all days, otherwise results of early days are evicted and
+recomputed.
+
+Processes can share a directory: every entry is written to its own temporary
+file and renamed into place, so readers never see partial entries.
+"""
+
+from collections import OrderedDict
+import functools
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import types
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+class ResultCache:
+    """
+    Cache of pipeline results with an in-memory LRU and optional disk storage.
+
+    :param directory: directory for pickled results, or None for memory only.
+    :param max_bytes: maximum size of the results kept in memory.
+    """
+
+    def __init__(self, directory=None, max_bytes=256 * 2**20):
+        assert max_bytes > 0
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        # key --> size in bytes of the result in memory
+        self._sizes = {}
+        self._bytes = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __contains__(self, key):
+        return key in self._memory or \
+            (self.directory is not None and os.path.exists(self._path(key)))
+
+    def key(self, *parts):
+        """
+        Create a cache key from hashes, parameters and distance functions.
+
+        :param parts: strings, numbers, tuples or callables identifying a result.
+        :return: hex digest.
+        """
+        h = hashlib.sha1()
+        for p in parts:
+            h.update(_key_part(p).encode('utf-8'))
+            h.update(b'\x00')
+        return h.hexdigest()
+
+    @staticmethod
+    def hash_frame(df):
+        """
+        Hash the contents of a dataframe, ignoring its index.
+
+        :param df: dataframe to hash.
+        :return: hex digest.
+        """
+        values = pd.util.hash_pandas_object(df, index=False).values
+        return hashlib.sha1(values.tobytes()).hexdigest()
+
+    @staticmethod
+    def fingerprint_days(df, columns):
+        """
+        Hash the points of each day of one user.
+
+        Rows are hashed once and the digest of a day is computed from its rows,
+        so fingerprinting is cheap compared to recomputing the day.
+
+        :param df: dataframe of location points of one user sorted chronologically
+                   with columns: user_id, date and the given columns.
+        :param columns: columns to hash.
+        :return: dict of date --> hex digest.
+        """
+        digests = {}
+        if df.empty:
+            return digests
+        rows = pd.util.hash_pandas_object(df[columns], index=False).values
+        dates = df['date'].values
+        # days are contiguous when points are sorted chronologically
+        starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+        stops = np.r_[starts[1:], len(df)]
+        for start, stop in zip(starts, stops):
+            digests[pd.Timestamp(dates[start])] = \
+                hashlib.sha1(rows[start:stop].tobytes()).hexdigest()
+        return digests
+
+    def get(self, key, default=None):
+        """
+        Get a copy of a cached result.
+
+        :param key: cache key.
+        :param default: value returned if the key is not cached.
+        :return: cached result or default.
+        """
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return _copy(self._memory[key])
+        if self.directory is not None and os.path.exists(self._path(key)):
+            with open(self._path(key), 'rb') as f:
+                value = pickle.load(f)
+            self._remember(key, value)
+            self.hits += 1
+            return _copy(value)
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """
+        Store a copy of a result.
+
+        :param key: cache key.
+        :param value: dataframe or tuple of dataframes.
+        """
+        value = _copy(value)
+        self._remember(key, value)
+        if self.directory is not None:
+            self._dump(key, value)
+
+    def clear(self):
+        """Remove all results from memory and disk."""
+        self._memory.clear()
+        self._sizes.clear()
+        self._bytes = 0
+        if self.directory is not None:
+            for f in os.listdir(self.directory):
+                if f.endswith('.pkl'):
+                    os.remove(os.path.join(self.directory, f))
+
+    def _remember(self, key, value):
+        self._bytes -= self._sizes.get(key, 0)
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        self._sizes[key] = _size(value)
+        self._bytes += self._sizes[key]
+        # keep at least the newest result
+        while self._bytes > self.max_bytes and len(self._memory) > 1:
+            evicted, _ = self._memory.popitem(last=False)
+            self._bytes -= self._sizes.pop(evicted)
+            self.evictions += 1
+            if self.directory is None and self.evictions == 1:
+                warnings.warn('ResultCache evicts results beyond max_bytes=%d, evicted results '
+                              'are recomputed; give a directory to keep them' % self.max_bytes,
+                              RuntimeWarning, stacklevel=3)
+
+    def _dump(self, key, value):
+        # a unique temporary file per write, processes may write the same key concurrently
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=key, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pkl')
+
+
+def _key_part(p, seen=()):
+    """
+    Convert part of a cache key to a string.
+
+    Functions are identified by their code, defaults and the values they
+    capture in closures, so equal lambdas share results and closures capturing
+    different values do not.
+
+    :raises ValueError: if the part has no deterministic representation, e.g.
+                        a repr with a memory address.
+    """
+    if isinstance(p, (tuple, list)):
+        return '(' + ','.join(_key_part(x, seen) for x in p) + ')'
+    if isinstance(p, dict):
+        return '{' + ','.join('%s:%s' % (_key_part(k, seen), _key_part(v, seen))
+                              for k, v in sorted(p.items(), key=lambda kv: repr(kv[0]))) + '}'
+    if isinstance(p, np.ndarray):
+        return 'array(%s,%r,%s)' % (p.dtype.str, p.shape,
+                                    hashlib.sha1(np.ascontiguousarray(p).tobytes()).hexdigest())
+    if isinstance(p, types.CodeType):
+        return 'code(%s,%s,%s)' % (p.co_code.hex(), _key_part(p.co_consts, seen),
+                                   _key_part(p.co_names, seen))
+    if callable(p) and not isinstance(p, type):
+        # wrapped distance functions are identified by the function they wrap
+        while hasattr(p, 'distf'):
+            p = p.distf
+        if id(p) in seen:
+            # recursive closures
+            return 'recursive:%s' % getattr(p, '__qualname__', type(p).__qualname__)
+        seen = seen + (id(p),)
+        if isinstance(p, functools.partial):
+            return 'partial(%s,%s,%s)' % (_key_part(p.func, seen), _key_part(p.args, seen),
+                                          _key_part(p.keywords, seen))
+        if isinstance(p, types.MethodType):
+            return 'method(%s,%s)' % (_key_part(p.__func__, seen), _key_part(p.__self__, seen))
+        if isinstance(p, types.FunctionType):
+            cells = tuple(_cell_contents(c) for c in p.__closure__ or ())
+            return '%s.%s:%s:%s:%s:%s' % (p.__module__, p.__qualname__,
+                                          _key_part(p.__code__, seen),
+                                          _key_part(p.__defaults__, seen),
+                                          _key_part(p.__kwdefaults__, seen),
+                                          _key_part(cells, seen))
+    r = repr(p)
+    if _ADDRESS.search(r):
+        raise ValueError('no deterministic cache key for %s, give it a __repr__ '
+                         'identifying its behavior' % r)
+    return r
+
+
+# memory addresses in default reprs such as <function f at 0x7f...>
+_ADDRESS = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def _cell_contents(cell):
+    try:
+        return cell.cell_contents
+    except ValueError:
+        return None  # empty cell
+
+
+def _size(value):
+    """Size in bytes of a result in memory."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    if isinstance(value, tuple):
+        return sum(_size(v) for v in value)
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _copy(value):
+    """Copy dataframes so cached results are not modified by callers."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(_copy(v) for v in value)
+    return value
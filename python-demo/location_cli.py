@@ -0,0 +1,347 @@
+"""
+Command-line batch runner for the location analysis pipeline.
+
+Raw location points are read from JSON, JSON lines, Parquet or location_codec
+files. Each user
+is preprocessed and run through get_stops_places_and_moves_daily and
+get_daily_features, with users distributed over --jobs worker processes. The
+points are published once in shared memory, see location.SharedPoints, and
+workers read the points of their users from there:
+
+    python -m location points.jsonl -o out --jobs 4
+    python location_cli.py multi_date_data.json -o out --distf haversine
+
+Results are partitioned by table and user:
+
+- <output>/<table>/user_id=<user_id>/part-0.<format> for the tables stops,
+  places, moves and features.
+- <output>/summary.json: input, parameters, rows per table, failed users and
+  time spent in each pipeline stage.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import location
+import location_codec
+
+
+TABLES = ['stops', 'places', 'moves', 'features']
+FORMATS = ['csv', 'jsonl', 'parquet']
+SUMMARY_FILE = 'summary.json'
+
+
+# input
+
+def read_points(paths):
+    """
+    Read raw location points from files.
+
+    JSON files may contain records or, as written by the demo notebooks, one
+    column per point. Points need the columns user_id, latitude, longitude and
+    either timestamp in milliseconds or datetime.
+
+    :param paths: list of .json, .jsonl, .ndjson, .parquet or .ltrj files.
+    :return: dataframe of location points with columns: user_id, timestamp, latitude, longitude.
+    """
+    frames = []
+    for path in paths:
+        ext = os.path.splitext(path)[1].lower()
+        if ext in ('.jsonl', '.ndjson'):
+            df = pd.read_json(path, lines=True, convert_dates=False)
+        elif ext == '.json':
+            df = pd.read_json(path, convert_dates=False)
+            if 'latitude' not in df.columns and 'latitude' in df.index:
+                df = df.T.infer_objects()
+        elif ext == '.parquet':
+            df = pd.read_parquet(path)
+        elif ext == location_codec.EXTENSION:
+            df = location_codec.load(path)
+        else:
+            raise ValueError('unsupported input format: %s' % path)
+        frames.append(df)
+    return normalize_points(pd.concat(frames, ignore_index=True))
+
+
+def normalize_points(df):
+    """
+    Select and convert the columns of raw location points.
+
+    :param df: dataframe of location points with columns: user_id, latitude or lat,
+               longitude or lon and timestamp in milliseconds or datetime.
+    :return: dataframe of location points with columns: user_id, timestamp, latitude, longitude.
+    """
+    df = df.rename(columns={'lat': 'latitude', 'lon': 'longitude'})
+    # integer user ids become floats when points are stored as columns
+    if pd.api.types.is_float_dtype(df['user_id']) and (df['user_id'] % 1 == 0).all():
+        df['user_id'] = df['user_id'].astype('int64')
+    if 'timestamp' not in df.columns and 'datetime' in df.columns:
+        if pd.api.types.is_numeric_dtype(df['datetime']):
+            df['timestamp'] = df['datetime']
+        else:
+            df['timestamp'] = pd.to_datetime(df['datetime']).values.astype('int64') // 10**6
+    for c in ['timestamp', 'latitude', 'longitude']:
+        df[c] = pd.to_numeric(df[c])
+    return df[['user_id', 'timestamp', 'latitude', 'longitude']]
+
+
+# pipeline
+
+def run_user(points, output, fmt='csv', distf='geodesic', min_samples_per_day=1,
+             cache_dir=None, **params):
+    """
+    Run the full pipeline for one user and write the results.
+
+    :param points: dataframe of raw location points of one user.
+    :param output: output directory.
+    :param fmt: output format, one of FORMATS.
+    :param distf: name of the distance function, 'geodesic', 'haversine' or 'local'.
+    :param min_samples_per_day: passed to preprocess.
+    :param cache_dir: optional directory of a ResultCache shared between runs.
+    :param params: parameters passed to get_stops_places_and_moves_daily.
+    :return: dict with rows per table and profiler records.
+    """
+    user_id, tables, records = compute_user(points, distf, min_samples_per_day, cache_dir,
+                                            **params)
+    for name, table in tables.items():
+        write_partition(table, output, name, user_id, fmt)
+    return {'rows': {name: len(table) for name, table in tables.items()},
+            'records': records}
+
+
+def compute_user(points, distf='geodesic', min_samples_per_day=1, cache_dir=None, **params):
+    """
+    Run the full pipeline for one user.
+
+    :param points: dataframe of raw location points of one user.
+    :param distf: name of the distance function, 'geodesic', 'haversine' or 'local'.
+    :param min_samples_per_day: passed to preprocess.
+    :param cache_dir: optional directory of a ResultCache shared between runs.
+    :param params: parameters passed to get_stops_places_and_moves_daily.
+    :return: user id, dict of dataframes per table and profiler records.
+    """
+    profiler = location.Profiler()
+    distf = _distance_function(distf)
+    cache = None
+    if cache_dir is not None:
+        from location_cache import ResultCache
+        cache = ResultCache(cache_dir)
+    df = location.preprocess(points, min_samples_per_day, profiler=profiler)
+    stops, places, moves = location.get_stops_places_and_moves_daily(
+        df, distf=distf, cache=cache, profiler=profiler, **params)
+    user_id = df.user_id.values[0]
+    with profiler.stage('features', user_id, rows_in=len(stops)) as record:
+        features = location.get_daily_features(df, stops, moves, distf)
+        record['rows_out'] = len(features)
+    tables = {'stops': stops, 'places': places, 'moves': moves, 'features': features}
+    return user_id, tables, profiler.records
+
+
+def _run_user(args):
+    """Run run_user in a worker process, returning errors instead of raising them."""
+    user_id, points, kwargs = args
+    try:
+        return user_id, run_user(points, **kwargs), None
+    except Exception as e:
+        return user_id, None, '%s: %s' % (type(e).__name__, e)
+
+
+def _run_shared_user(user_id):
+    """Run _run_user for a user of the shared points of a worker process."""
+    w = location._WORKER
+    return _run_user((user_id, w['points'].user_frame(user_id), w['kwargs']))
+
+
+def _distance_function(name):
+    if name == 'haversine':
+        return location.haversine_distance
+    if name == 'geodesic':
+        return location.geodesic_distance
+    if name == 'local':
+        # projected per user by the pipeline
+        return name
+    raise ValueError('unknown distance function: %s' % name)
+
+
+# output
+
+def write_partition(df, output, table, user_id, fmt='csv', name='part-0'):
+    """
+    Write the rows of one user to a table partition.
+
+    :param df: dataframe to write.
+    :param output: output directory.
+    :param table: name of the table.
+    :param user_id: id of the user.
+    :param fmt: output format, one of FORMATS.
+    :param name: name of the file in the partition, without extension.
+    :return: path of the written file.
+    """
+    directory = os.path.join(output, table, 'user_id=%s' % user_id)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, '%s.%s' % (name, fmt))
+    # write to a unique temporary file first so readers never see a partial partition
+    # and concurrent writers of the same partition do not share the temporary file
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        if fmt == 'csv':
+            df.to_csv(tmp, index=False)
+        elif fmt == 'jsonl':
+            df.to_json(tmp, orient='records', lines=True, date_format='iso')
+        elif fmt == 'parquet':
+            df.to_parquet(tmp, index=False)
+        else:
+            raise ValueError('unknown output format: %s' % fmt)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return path
+
+
+def read_partition(output, table, user_id, fmt='csv', name='part-0'):
+    """
+    Read a table partition written by write_partition.
+
+    :param output: output directory.
+    :param table: name of the table.
+    :param user_id: id of the user.
+    :param fmt: output format, one of FORMATS.
+    :param name: name of the file in the partition, without extension.
+    :return: dataframe, None if the partition does not exist.
+    """
+    path = os.path.join(output, table, 'user_id=%s' % user_id, '%s.%s' % (name, fmt))
+    if not os.path.exists(path):
+        return None
+    if fmt == 'csv':
+        return pd.read_csv(path)
+    if fmt == 'jsonl':
+        return pd.read_json(path, lines=True, convert_dates=False)
+    if fmt == 'parquet':
+        return pd.read_parquet(path)
+    raise ValueError('unknown output format: %s' % fmt)
+
+
+def run(paths, output, jobs=1, fmt='csv', distf='geodesic', min_samples_per_day=1,
+        cache_dir=None, verbose=False, **params):
+    """
+    Run the pipeline for all users in the input files.
+
+    :param paths: list of input files.
+    :param output: output directory.
+    :param jobs: number of worker processes, users are processed in parallel.
+    :param verbose: print progress of each user.
+    :return: summary dict, also written to <output>/summary.json.
+    """
+    start = time.perf_counter()
+    points = read_points(paths)
+    read_seconds = time.perf_counter() - start
+    kwargs = dict(params, output=output, fmt=fmt, distf=distf,
+                  min_samples_per_day=min_samples_per_day, cache_dir=cache_dir)
+    points = points.sort_values('user_id', kind='mergesort')
+    users = points.user_id.unique().tolist()
+    os.makedirs(output, exist_ok=True)
+    profiler = location.Profiler()
+    rows = {name: 0 for name in TABLES}
+    failed = {}
+    shared = executor = None
+    if jobs > 1:
+        # workers read the points of their users from shared memory
+        shared = location.SharedPoints.publish(points, ['timestamp', 'latitude', 'longitude'])
+        executor = ProcessPoolExecutor(max_workers=jobs, initializer=location._init_worker,
+                                       initargs=(shared.spec, {'kwargs': kwargs}))
+        results = executor.map(_run_shared_user, users)
+    else:
+        results = map(_run_user, ((user_id, p, kwargs)
+                                  for user_id, p in points.groupby('user_id', sort=False)))
+    try:
+        for user_id, res, error in results:
+            if error is not None:
+                failed[str(user_id)] = error
+            else:
+                profiler.records.extend(res['records'])
+                for name, n in res['rows'].items():
+                    rows[name] += n
+            if verbose:
+                print('%-40s %s' % (user_id, error or 'ok'), file=sys.stderr)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+            shared.close()
+    summary = {
+        'input': list(paths),
+        'output': output,
+        'format': fmt,
+        'jobs': jobs,
+        'distf': distf,
+        'min_samples_per_day': min_samples_per_day,
+        'params': params,
+        'points': len(points),
+        'users': len(users),
+        'failed': failed,
+        'rows': rows,
+        'read_seconds': read_seconds,
+        'seconds': time.perf_counter() - start,
+        'stages': [{k: location._json_value(v) for k, v in r.items()}
+                   for r in profiler.summary().to_dict('records')],
+    }
+    with open(os.path.join(output, SUMMARY_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m location',
+        description='Compute stops, places, moves and daily features from location points.')
+    parser.add_argument('input', nargs='+', help='.json, .jsonl, .parquet or .ltrj files of points')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--distf', choices=['geodesic', 'haversine', 'local'], default='geodesic')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='ResultCache directory, reruns only recompute changed days')
+    parser.add_argument('--min-samples-per-day', type=int, default=1)
+    parser.add_argument('--stop-algorithm', choices=sorted(location.STOP_ALGORITHMS),
+                        default='distance_grouping')
+    parser.add_argument('--backend', choices=location.BACKENDS, default='numpy',
+                        help='backend of the distance_grouping kernel')
+    parser.add_argument('--stop-duration', type=float, default=15, help='minutes')
+    parser.add_argument('--stop-dist', type=float, default=25, help='meters')
+    parser.add_argument('--place-dist', type=float, default=25, help='meters')
+    parser.add_argument('--move-duration', type=float, default=5, help='minutes')
+    parser.add_argument('--move-dist', type=float, default=50, help='meters')
+    parser.add_argument('--no-merge', dest='merge', action='store_false',
+                        help='do not merge nearby stops')
+    parser.add_argument('--merge-dist', type=float, default=25, help='meters')
+    parser.add_argument('--merge-time', type=float, default=5, help='minutes')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    summary = run(args.input, args.output, args.jobs, args.format, args.distf,
+                  args.min_samples_per_day, args.cache, verbose=not args.quiet,
+                  stop_duration=args.stop_duration, stop_dist=args.stop_dist,
+                  place_dist=args.place_dist, move_duration=args.move_duration,
+                  move_dist=args.move_dist, merge=args.merge, merge_dist=args.merge_dist,
+                  merge_time=args.merge_time, stop_algorithm=args.stop_algorithm,
+                  backend=args.backend)
+    if not args.quiet:
+        print('%d users, %d failed, %.2f s' % (summary['users'], len(summary['failed']),
+                                              summary['seconds']), file=sys.stderr)
+        for stage in summary['stages']:
+            print('%-14s %6d runs %10.4f s' % (stage['stage'], stage['runs'], stage['seconds']),
+                  file=sys.stderr)
+    if summary['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+"""
+Compact binary format for location points.
+
+Points stored as JSON take about 100 bytes each. This format stores the
+points of each user-day as a block of three columns: timestamps in
+milliseconds and latitudes and longitudes in fixed point with 7 decimals
+(about 1 cm). Each column stores its first value followed by the differences
+between consecutive values, zigzag and varint encoded, so a point sampled
+every minute takes about 7 bytes before compression. Blocks can be
+compressed with zlib, or zstd if the zstandard package is installed.
+
+Layout of an encoded trajectory, integers are little-endian:
+
+- header: magic b'LTRJ', version u1, compression u1, reserved u2,
+  number of users u4, number of blocks u4, bytes of the user list u4.
+- user list: JSON list of user ids.
+- index: one INDEX_DTYPE entry per block with the user, date as days since
+  1970-01-01 in UTC, number of points, offset from the start of the blocks
+  and size in bytes.
+- blocks.
+
+Only the blocks of the requested users and dates are decompressed and
+decoded. Encoding and decoding are vectorized over all blocks, and decode
+returns the columns preprocess takes:
+
+    data = encode(points, compression='zlib')
+    df = preprocess(decode(data, user_id='u1', start='2020-04-23', end='2020-04-30'))
+"""
+
+import json
+import struct
+import zlib
+
+import numpy as np
+import pandas as pd
+
+
+MAGIC = b'LTRJ'
+VERSION = 1
+EXTENSION = '.ltrj'
+HEADER = struct.Struct('<4sBBHIII')
+INDEX_DTYPE = np.dtype([('user', '<u4'), ('date', '<i4'), ('points', '<u4'),
+                        ('offset', '<u8'), ('size', '<u4')])
+COMPRESSIONS = [None, 'zlib', 'zstd']
+# fixed point scale of latitude and longitude
+SCALE = 10**7
+MS_PER_DAY = 86400 * 1000
+# columns of a block in the order they are stored
+COLUMNS = ['timestamp', 'latitude', 'longitude']
+
+
+def encode(df, compression=None, level=None):
+    """
+    Encode location points.
+
+    :param df: dataframe of location points with columns: user_id, timestamp in
+               milliseconds, latitude and longitude.
+    :param compression: compression of blocks, one of COMPRESSIONS.
+    :param level: compression level, None for the default of the compression.
+    :return: bytes.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError('unknown compression: %s' % compression)
+    if df[['timestamp', 'latitude', 'longitude']].isna().any().any():
+        raise ValueError('points without timestamp or coordinates cannot be encoded')
+    df = df.sort_values(['user_id', 'timestamp'], kind='mergesort')
+    user_ids = df.user_id.values
+    values = np.vstack([np.round(df.timestamp.values.astype(float)).astype(np.int64),
+                        np.round(df.latitude.values.astype(float) * SCALE).astype(np.int64),
+                        np.round(df.longitude.values.astype(float) * SCALE).astype(np.int64)])
+    # blocks of user-days
+    days = values[0] // MS_PER_DAY
+    first = np.r_[True, (user_ids[1:] != user_ids[:-1]) | (days[1:] != days[:-1])] \
+        if len(df) else np.zeros(0, dtype=bool)
+    starts = np.flatnonzero(first)
+    counts = np.diff(np.r_[starts, len(df)])
+    users, user_index = np.unique(user_ids[starts], return_inverse=True) \
+        if len(df) else ([], np.zeros(0, dtype=int))
+    # first value of each block followed by differences
+    deltas = np.diff(values, axis=1, prepend=0)
+    deltas[:, starts] = values[:, starts]
+    raw, lengths = _varint_encode(_zigzag_encode(_block_order(deltas, counts)))
+    sizes = np.add.reduceat(lengths, 3 * starts) if len(starts) else np.zeros(0, dtype=np.int64)
+    blocks = np.split(raw, np.cumsum(sizes)[:-1]) if len(sizes) else []
+    if compression is not None:
+        compress = _compressor(compression, level)
+        blocks = [np.frombuffer(compress(b.tobytes()), dtype=np.uint8) for b in blocks]
+        sizes = np.array([len(b) for b in blocks], dtype=np.int64)
+    index = np.zeros(len(starts), dtype=INDEX_DTYPE)
+    index['user'] = user_index
+    index['date'] = days[starts]
+    index['points'] = counts
+    index['size'] = sizes
+    index['offset'] = np.cumsum(sizes) - sizes
+    user_list = json.dumps(np.asarray(users).tolist()).encode('utf-8')
+    header = HEADER.pack(MAGIC, VERSION, COMPRESSIONS.index(compression), 0, len(users),
+                         len(index), len(user_list))
+    return b''.join([header, user_list, index.tobytes()] + [b.tobytes() for b in blocks])
+
+
+def decode(data, user_id=None, start=None, end=None):
+    """
+    Decode location points.
+
+    :param data: bytes of encoded points.
+    :param user_id: user to decode, or None for all users.
+    :param start: first date to decode, or None.
+    :param end: last date to decode, or None.
+    :return: dataframe of location points sorted by user and time with columns:
+             user_id, timestamp in milliseconds, latitude and longitude.
+    """
+    compression, users, index, body = _parse(data)
+    selected = np.ones(len(index), dtype=bool)
+    if user_id is not None:
+        selected &= index['user'] == (users.index(user_id) if user_id in users else -1)
+    if start is not None:
+        selected &= index['date'] >= _days(start)
+    if end is not None:
+        selected &= index['date'] <= _days(end)
+    index = index[selected]
+    blocks = [body[o:o + s] for o, s in zip(index['offset'], index['size'])]
+    if compression is not None:
+        decompress = _decompressor(compression)
+        blocks = [decompress(b) for b in blocks]
+    counts = index['points'].astype(np.int64)
+    raw = np.frombuffer(b''.join(blocks), dtype=np.uint8)
+    deltas = _block_order(_zigzag_decode(_varint_decode(raw, 3 * counts.sum())), counts,
+                          inverse=True)
+    # cumulative sums restart at the first value of each block
+    starts = np.cumsum(counts) - counts
+    sums = np.cumsum(deltas, axis=1)
+    before = np.where(starts > 0, sums[:, np.maximum(starts - 1, 0)], 0)
+    values = sums - np.repeat(before, counts, axis=1)
+    return pd.DataFrame({
+        'user_id': np.repeat(np.array(users, dtype=object)[index['user']], counts)
+        if len(users) else np.zeros(0, dtype=object),
+        'timestamp': values[0],
+        'latitude': values[1] / SCALE,
+        'longitude': values[2] / SCALE,
+    })
+
+
+def read_index(data):
+    """
+    Read the index of encoded points.
+
+    :param data: bytes of encoded points.
+    :return: dataframe with a row per block with columns: user_id, date, points and bytes.
+    """
+    _, users, index, _ = _parse(data)
+    return pd.DataFrame({
+        'user_id': [users[u] for u in index['user']],
+        'date': pd.to_datetime(index['date'].astype(np.int64), unit='D'),
+        'points': index['points'].astype(np.int64),
+        'bytes': index['size'].astype(np.int64),
+    })
+
+
+def save(df, path, compression='zlib', level=None):
+    """Encode location points to a file, see encode."""
+    with open(path, 'wb') as f:
+        f.write(encode(df, compression, level))
+
+
+def load(path, user_id=None, start=None, end=None):
+    """Decode location points from a file, see decode."""
+    with open(path, 'rb') as f:
+        return decode(f.read(), user_id, start, end)
+
+
+def _parse(data):
+    """Split encoded points into compression, user list, index and blocks."""
+    data = memoryview(data)
+    magic, version, compression, _, n_users, n_blocks, user_bytes = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not encoded location points')
+    if version != VERSION:
+        raise ValueError('unsupported version: %d' % version)
+    offset = HEADER.size
+    users = json.loads(bytes(data[offset:offset + user_bytes]).decode('utf-8'))
+    offset += user_bytes
+    index = np.frombuffer(data, dtype=INDEX_DTYPE, count=n_blocks, offset=offset)
+    offset += n_blocks * INDEX_DTYPE.itemsize
+    return COMPRESSIONS[compression], users, index, data[offset:]
+
+
+def _days(date):
+    """Days since 1970-01-01 of a date."""
+    return pd.Timestamp(date).value // (MS_PER_DAY * 10**6)
+
+
+def _block_order(values, counts, inverse=False):
+    """
+    Reorder columns of values of consecutive blocks to one flat array per block and back.
+
+    :param values: array of shape (columns, points), or the flat array if inverse.
+    :param counts: number of points of each block.
+    :return: flat array with the columns of each block after each other, or the
+             array of shape (columns, points) if inverse.
+    """
+    n_columns = len(COLUMNS)
+    n = int(np.sum(counts))
+    block = np.repeat(np.arange(len(counts)), counts)
+    # position of each value in the flat array
+    row = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+    position = (3 * (np.cumsum(counts) - counts))[block] \
+        + np.arange(n_columns)[:, None] * counts[block] + row
+    if inverse:
+        return values[position]
+    flat = np.empty(n_columns * n, dtype=values.dtype)
+    flat[position] = values
+    return flat
+
+
+def _zigzag_encode(x):
+    """Map signed integers to unsigned integers with small absolute values first."""
+    return ((x << 1) ^ (x >> 63)).astype(np.uint64)
+
+
+def _zigzag_decode(u):
+    return ((u >> np.uint64(1)).astype(np.int64)) ^ -((u & np.uint64(1)).astype(np.int64))
+
+
+def _varint_encode(u):
+    """
+    Encode unsigned integers with 7 bits per byte, the high bit marks following bytes.
+
+    :param u: array of uint64.
+    :return: array of uint8 and number of bytes of each value.
+    """
+    lengths = np.ones(len(u), dtype=np.int64)
+    rest = u >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    out = np.empty(lengths.sum(), dtype=np.uint8)
+    starts = np.cumsum(lengths) - lengths
+    for k in range(lengths.max() if len(u) else 0):
+        m = lengths > k
+        byte = (u[m] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        out[starts[m] + k] = byte | (lengths[m] > k + 1).astype(np.uint64) << np.uint64(7)
+    return out, lengths
+
+
+def _varint_decode(b, n):
+    """
+    Decode unsigned integers, see _varint_encode.
+
+    :param b: array of uint8.
+    :param n: number of integers.
+    :return: array of uint64.
+    """
+    ends = np.flatnonzero(b < 0x80)
+    if len(ends) != n or (n and ends[-1] != len(b) - 1):
+        raise ValueError('corrupt encoded points')
+    starts = np.r_[0, ends[:-1] + 1]
+    lengths = ends - starts + 1
+    u = np.zeros(n, dtype=np.uint64)
+    for k in range(lengths.max() if n else 0):
+        m = lengths > k
+        u[m] |= (b[starts[m] + k] & 0x7f).astype(np.uint64) << np.uint64(7 * k)
+    return u
+
+
+def _compressor(compression, level=None):
+    """Function compressing bytes."""
+    if compression == 'zlib':
+        return lambda b: zlib.compress(b, -1 if level is None else level)
+    import zstandard
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress
+
+
+def _decompressor(compression):
+    """Function decompressing bytes."""
+    if compression == 'zlib':
+        return zlib.decompress
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress
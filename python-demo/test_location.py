@@ -0,0 +1,75 @@
+"""Tests of the location module, run with: python -m pytest from python-demo."""
+
+import pandas as pd
+import pytest
+
+import location
+import location_bench
+
+
+# seconds, importing location is dominated by importing pandas
+IMPORT_BUDGET = 1.0
+
+
+def test_import_budget():
+    # fresh interpreters, the fastest of a few imports is compared to the budget
+    seconds, modules = location_bench.import_time('location', repeat=3)
+    assert modules == [], 'imported up front: %s' % ', '.join(modules)
+    assert seconds < IMPORT_BUDGET
+
+
+@pytest.fixture(scope='module')
+def pipeline():
+    df = location.preprocess(location_bench.synthetic_points(n_users=2, n_days=4, sampling=300))
+    results = [location.get_stops_places_and_moves_daily(points, distf=location.haversine_distance)
+               for _, points in df.groupby('user_id')]
+    stops = pd.concat([stops for stops, _, _ in results], ignore_index=True)
+    moves = pd.concat([moves for _, _, moves in results], ignore_index=True)
+    return df, stops, moves
+
+
+def test_features_as_of_end_of_day(pipeline):
+    df, stops, moves = pipeline
+    times = [d + pd.Timedelta('23:59:59.999') for d in sorted(df.date.unique())]
+    features = location.get_daily_features_as_of(df, stops, moves, times,
+                                                 location.haversine_distance)
+    expected = location.get_daily_features(df, stops, moves, location.haversine_distance)
+    pd.testing.assert_frame_equal(features.drop(columns='time'), expected, check_dtype=False)
+
+
+def test_features_as_of_count_stops_and_moves_until_the_time(pipeline):
+    df, stops, moves = pipeline
+    times = [d + pd.Timedelta('12:00:00') for d in sorted(df.date.unique())]
+    features = location.get_daily_features_as_of(df, stops, moves, times,
+                                                 location.haversine_distance)
+    for row in features.itertuples():
+        day = (stops.user_id == row.user_id) & (stops.date == row.date)
+        assert row.number_of_stops == (day & (stops.arrival <= row.time)).sum()
+        day = (moves.user_id == row.user_id) & (moves.date == row.date)
+        assert row.number_of_moves == (day & (moves.arrival <= row.time)).sum()
+
+
+def test_rolling_features_match_features_of_the_window():
+    points = location_bench.synthetic_points(n_users=1, n_days=10, sampling=600, seed=5)
+    # days without data inside the windows
+    day = pd.to_datetime(points.timestamp, unit='ms').dt.day
+    df = location.preprocess(points[~day.isin([24, 25, 28])])
+    stops, _, _ = location.get_stops_places_and_moves_daily(df, distf=location.haversine_distance)
+    features = location.get_rolling_features(df, stops, windows=(3,))
+    assert features.date.tolist() == sorted(df.date.unique())
+    projection = location.local_projection(stops, max_extent=float('inf'))
+    for row in features.itertuples():
+        start = row.date - pd.Timedelta(days=2)
+        s = stops[(stops.date >= start) & (stops.date <= row.date)]
+        p = df[(df.date >= start) & (df.date <= row.date)]
+        expected = {
+            'number_of_places': s.place.nunique(),
+            'entropy': location.entropy(s),
+            'radius_of_gyration': location.radius_of_gyration(s, projection),
+            'log_variance': location.log_variance(p),
+            'routine_index': location.routine_index(s, row.date)
+            if row.date in s.date.values else float('nan'),
+        }
+        for feature, value in expected.items():
+            assert getattr(row, feature + '_3d') == pytest.approx(value, rel=1e-7, abs=1e-9,
+                                                                  nan_ok=True)
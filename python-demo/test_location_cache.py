@@ -0,0 +1,48 @@
+"""Tests of the result cache, run with: python -m pytest from python-demo."""
+
+from functools import partial
+
+import pytest
+
+import location
+import location_bench
+from location_cache import ResultCache
+
+
+def _scaled(factor):
+    return lambda a, b: factor * location.haversine_distance(a, b)
+
+
+def test_closures_are_keyed_by_captured_values():
+    cache = ResultCache()
+    assert cache.key('stops', _scaled(1)) == cache.key('stops', _scaled(1))
+    assert cache.key('stops', _scaled(1)) != cache.key('stops', _scaled(2))
+
+
+def test_partials_are_keyed_by_arguments():
+    cache = ResultCache()
+    f = partial(location.merge_stops, dist=25)
+    assert cache.key(f) == cache.key(partial(location.merge_stops, dist=25))
+    assert cache.key(f) != cache.key(partial(location.merge_stops, dist=50))
+    assert cache.key(f) != cache.key(partial(location.get_places, dist=25))
+
+
+def test_objects_without_deterministic_repr_are_rejected():
+    with pytest.raises(ValueError):
+        ResultCache().key(object())
+
+
+def test_place_dist_change_reuses_stops():
+    df = location.preprocess(location_bench.synthetic_points(n_users=1, n_days=3, sampling=300))
+    cache = ResultCache()
+    location.get_stops_places_and_moves_daily(df, distf=location.haversine_distance,
+                                              cache=cache)
+    profiler = location.Profiler()
+    stops, _, _ = location.get_stops_places_and_moves_daily(
+        df, place_dist=50, distf=location.haversine_distance, cache=cache, profiler=profiler)
+    stages = {r['stage'] for r in profiler.records}
+    assert 'get_stops' not in stages and 'merge_stops' not in stages
+    assert 'get_places' in stages
+    expected, _, _ = location.get_stops_places_and_moves_daily(
+        df, place_dist=50, distf=location.haversine_distance)
+    assert stops.equals(expected)
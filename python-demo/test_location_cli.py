@@ -0,0 +1,16 @@
+"""Tests of the batch runner, run with: python -m pytest from python-demo."""
+
+import location_bench
+import location_cli
+
+
+def test_parallel_runs_share_cache(tmp_path):
+    # workers of both runs write and read entries of the same cache directory
+    path = str(tmp_path / 'points.jsonl')
+    location_bench.synthetic_points(n_users=48, n_days=1, sampling=900).to_json(
+        path, orient='records', lines=True)
+    for run in ('first', 'second'):
+        summary = location_cli.run([path], str(tmp_path / run), jobs=8, distf='haversine',
+                                   cache_dir=str(tmp_path / 'cache'))
+        assert summary['failed'] == {}
+        assert summary['rows']['features'] == 48
@@ -0,0 +1,40 @@
+"""Tests of the binary points format, run with: python -m pytest from python-demo."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import location_bench
+import location_codec
+
+
+@pytest.fixture(scope='module')
+def points():
+    df = location_bench.synthetic_points(n_users=2, n_days=3, sampling=300)
+    df['user_id'] = df.user_id.map({0: 'u0', 1: 'u1'})
+    # negative coordinates and deltas of both signs
+    df.loc[df.user_id == 'u1', 'longitude'] *= -1
+    return df.sort_values(['user_id', 'timestamp'], kind='mergesort').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_round_trip_quantizes_to_seven_decimals(points, compression):
+    df = location_codec.decode(location_codec.encode(points, compression))
+    assert df.user_id.tolist() == points.user_id.tolist()
+    assert (df.timestamp.values == points.timestamp.values).all()
+    for c in ['latitude', 'longitude']:
+        np.testing.assert_array_less(np.abs(df[c].values - points[c].values), 0.5e-7 + 1e-12)
+        # values already on the grid are decoded exactly
+        np.testing.assert_array_equal(df[c].values, np.round(points[c].values * 1e7) / 1e7)
+
+
+def test_decode_selects_user_and_dates(points):
+    data = location_codec.encode(points)
+    dates = pd.to_datetime(points.timestamp, unit='ms').dt.normalize()
+    start, end = sorted(dates.unique())[1:3]
+    df = location_codec.decode(data, user_id='u1', start=start, end=end)
+    expected = points[(points.user_id == 'u1') & (dates >= start) & (dates <= end)]
+    assert df.timestamp.tolist() == expected.timestamp.tolist()
+    index = location_codec.read_index(data)
+    assert index.points.sum() == len(points)
+    assert len(index) == 6
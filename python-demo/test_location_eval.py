@@ -0,0 +1,64 @@
+"""Tests of the evaluation of features against answers, run with: python -m pytest."""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import location
+import location_bench
+import location_eval
+import location_sweep
+
+
+@pytest.fixture(scope='module')
+def pipeline():
+    df = location.preprocess(location_bench.synthetic_points(n_users=1, n_days=4, sampling=300))
+    stops, places, moves = location.get_stops_places_and_moves_daily(
+        df, distf=location.haversine_distance)
+    features = location.get_daily_features(df, stops, moves, location.haversine_distance)
+    features = features.merge(location_eval.feature_times(stops), how='left')
+    return df, features
+
+
+def _answers(features):
+    """Answers agreeing with the features on every day."""
+    elapsed = (features.datetime - features.date).dt.total_seconds() / 3600
+    return pd.DataFrame({'user_id': features.user_id, 'date': features.date,
+                         'places': features.number_of_places,
+                         'home': elapsed * (1 - features.home_stay),
+                         'routine_scale': 5 * (1 - features.routine_index)})
+
+
+def test_daily_features_match_their_answers(pipeline):
+    _, features = pipeline
+    res = location_eval.evaluate(features, _answers(features)).set_index('feature')
+    assert set(res.index) == set(location_eval.FEATURES)
+    assert (res.n > 0).all()
+    np.testing.assert_allclose(res.mae, 0, atol=1e-9)
+
+
+def test_app_routine_overlap_is_not_inverted(pipeline):
+    _, features = pipeline
+    answers = _answers(features)
+    app = features.drop(columns='routine_index').assign(
+        routine_overlap=1 - features.routine_index)
+    res = location_eval.evaluate(app, answers).set_index('feature')
+    np.testing.assert_allclose(res.loc['routine', 'mae'], 0, atol=1e-9)
+    # the routine index itself differs from the answers where the day was not routine
+    errors = location_eval.errors(features, answers.assign(
+        routine_scale=5 * features.routine_index))
+    assert errors[errors.feature == 'routine'].error.abs().max() > 0
+
+
+def test_sweep_results_match_their_answers(pipeline):
+    df, features = pipeline
+    results = location_sweep.sweep(df, {'place_dist': [25]}, distf=location.haversine_distance)
+    res = location_eval.evaluate(results, _answers(features), by=location_sweep.PARAMS,
+                                 per_user=False)
+    np.testing.assert_allclose(res.mae, 0, atol=1e-9)
+
+
+def test_features_need_datetime(pipeline):
+    _, features = pipeline
+    with pytest.raises(ValueError):
+        location_eval.errors(features.drop(columns='datetime'), _answers(features))
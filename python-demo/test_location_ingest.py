@@ -0,0 +1,31 @@
+"""Tests of the ingestion of uploaded points, run with: python -m pytest from python-demo."""
+
+import os
+
+import pandas as pd
+
+import location
+import location_bench
+import location_cli
+import location_ingest
+
+
+def test_history_window_keeps_days_and_place_labels(tmp_path):
+    points = location_bench.synthetic_points(n_users=1, n_days=4, sampling=300)
+    dates = pd.to_datetime(points.timestamp, unit='ms').dt.normalize()
+    output = str(tmp_path / 'out')
+    for date in sorted(dates.unique()):
+        location_ingest.ingest_user(0, points[dates == date], str(tmp_path / 'points'), 2,
+                                    output=output, distf='haversine')
+    features = sorted(os.listdir(os.path.join(output, 'features', 'user_id=0')))
+    assert features == [pd.Timestamp(d).strftime('%Y-%m-%d.csv') for d in sorted(dates.unique())]
+    # every stop keeps the label of the stored place it is at
+    places = location_cli.read_partition(output, 'places', 0).set_index('place')
+    stops = pd.concat([pd.read_csv(os.path.join(output, 'stops', 'user_id=0', f))
+                       for f in features], ignore_index=True)
+    assert set(stops.place) == set(places.index)
+    assert (stops.groupby('place').size() == places.stops).all()
+    d = location.haversine(stops.latitude, stops.longitude,
+                           places.latitude[stops.place].values,
+                           places.longitude[stops.place].values)
+    assert d.max() < 25
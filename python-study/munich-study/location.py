@@ -4,24 +4,40 @@ Tools for analysis of location data.
 Author: Jonas Busk (jonasbusk@gmail.com)
 """
 
+from collections import Counter, namedtuple
+from contextlib import contextmanager, nullcontext
 from datetime import datetime
+import json
+import pickle
+import sys
+import time
 import warnings
 
-from geopy.distance import geodesic
 import numpy as np
 import pandas as pd
-from sklearn.cluster import DBSCAN
+
+# geopy, scipy and sklearn are slow to import and only needed by some functions,
+# so they are imported on first use
 
 
 # preprocessing
 
-def preprocess(df, min_samples_per_day=1, inplace=False):
+def preprocess(df, min_samples_per_day=1, inplace=False, profiler=None):
     """
     Preprocess location data and remove outliers.
 
     :param df: dataframe of location points.
+    :param profiler: optional Profiler recording the time spent preprocessing.
     :return: preprocessed dataframe of location points.
     """
+    profiler = profiler if profiler is not None else _NO_PROFILER
+    with profiler.stage('preprocess', rows_in=len(df)) as record:
+        df = _preprocess(df, min_samples_per_day, inplace)
+        record['rows_out'] = len(df)
+    return df
+
+
+def _preprocess(df, min_samples_per_day, inplace):
     required_columns = ['user_id', 'timestamp', 'longitude', 'latitude']
     speed_of_sound = 343  # m/s
 
@@ -62,14 +78,16 @@ def preprocess(df, min_samples_per_day=1, inplace=False):
     df = _compute_delta_columns(df)
 
     # drop speeds faster than the speed of sound
-    df = df[(df.speed_in < speed_of_sound)]
     # repeat until no more rows are dropped
-    while True:
-        N = df.shape[0]
-        df = _compute_delta_columns(df)
-        df = df[(df.speed_in < speed_of_sound) & (df.speed_out < speed_of_sound)]
-        if N == df.shape[0]:
-            break
+    lat, lon = df.lat.values.astype(float), df.lon.values.astype(float)
+    seconds = df.datetime.values.astype('datetime64[ns]').astype(np.int64) / 1e9
+    users = df.user_id.values
+    starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]])
+    keep = np.ones(len(df), dtype=bool)
+    for start, stop in zip(starts, np.r_[starts[1:], len(df)]):
+        keep[start:stop] = _speed_filter(lat[start:stop], lon[start:stop], seconds[start:stop],
+                                         float(speed_of_sound))
+    df = _compute_delta_columns(df[keep].copy())
 
     # filter minimum number of samples per day
     df = df[df.groupby(['user_id', 'date']).lat.transform('count') >= min_samples_per_day]
@@ -103,8 +121,123 @@ def _compute_delta_columns(df):
     return df
 
 
+def simplify(df, stationary_dist=10, tolerance=5):
+    """
+    Simplify preprocessed location data before extracting stops and moves.
+
+    Each day of each user is simplified in two steps:
+
+    1. Stationary runs of at least three points within stationary_dist meters
+       of their first point are collapsed to their first and last point, so
+       arrival and departure times at stops are preserved exactly.
+    2. Remaining points between stationary runs are simplified with the
+       Douglas-Peucker algorithm, dropping points within tolerance meters of
+       the simplified path. Move lengths only lose detours smaller than this.
+
+    Kept points get a weight column with the number of original samples they
+    represent, which is used for the samples columns of stops and moves.
+
+    :param df: dataframe of preprocessed location points with columns:
+               user_id, datetime, date, latitude, longitude.
+    :param stationary_dist: maximum distance of a stationary point from the first point of its run.
+    :param tolerance: maximum distance of a dropped moving point from the simplified path.
+    :return: simplified dataframe of location points with a weight column.
+    """
+    required_columns = ['user_id', 'datetime', 'date', 'latitude', 'longitude']
+    # validate input
+    assert all(c in df.columns for c in required_columns)
+    df = df.sort_values(['user_id', 'datetime'])
+    if df.empty:
+        return df.assign(weight=np.zeros(0, dtype=int))
+    lat, lon = df.latitude.values, df.longitude.values
+    weight = df.weight.values if 'weight' in df.columns else np.ones(len(df), dtype=int)
+    keep = np.zeros(len(df), dtype=bool)
+    # days are simplified separately so no point represents samples of another day
+    new_day = (df.user_id.values[1:] != df.user_id.values[:-1]) | \
+        (df.date.values[1:] != df.date.values[:-1])
+    starts = np.flatnonzero(np.r_[True, new_day])
+    for start, stop in zip(starts, np.r_[starts[1:], len(df)]):
+        keep[start:stop] = _simplify_day(lat[start:stop], lon[start:stop],
+                                         stationary_dist, tolerance)
+    # dropped points add their weight to the previous kept point of the same day
+    kept = np.flatnonzero(keep)
+    df = df.iloc[kept].copy()
+    df['weight'] = np.add.reduceat(weight, kept)
+    if 'delta_meters' in df.columns:
+        df.rename(columns={'latitude': 'lat', 'longitude': 'lon'}, inplace=True)
+        df = _compute_delta_columns(df)
+        df.rename(columns={'lat': 'latitude', 'lon': 'longitude'}, inplace=True)
+    return df
+
+
+def _simplify_day(lat, lon, stationary_dist, tolerance):
+    """
+    Simplify location points of one user-day.
+
+    :return: boolean array of points to keep.
+    """
+    N = len(lat)
+    keep = np.zeros(N, dtype=bool)
+    # first and last point of stationary runs
+    runs = set()
+    i = 0
+    while i < N:
+        j = _first_point_outside(lat, lon, i, stationary_dist, haversine_distance, 16)
+        if j - i >= 3:
+            runs.add((i, j - 1))
+            i = j
+        else:
+            i += 1
+    # points that must be kept: first and last point of the day and of stationary runs
+    anchors = np.unique([0, N - 1] + [k for run in runs for k in run])
+    keep[anchors] = True
+    # simplify moving points between anchors in local metric coordinates
+    y = np.radians(lat) * 6371000
+    x = np.radians(lon) * 6371000 * np.cos(np.radians(np.mean(lat)))
+    for a, b in zip(anchors[:-1], anchors[1:]):
+        if b - a > 1 and (a, b) not in runs:
+            keep[a:b + 1] |= _douglas_peucker(x[a:b + 1], y[a:b + 1], tolerance)
+    return keep
+
+
+def _douglas_peucker(x, y, tolerance):
+    """
+    Simplify a path with the Douglas-Peucker algorithm.
+
+    :param x: array of east coordinates in meters.
+    :param y: array of north coordinates in meters.
+    :param tolerance: maximum distance of a dropped point from the simplified path.
+    :return: boolean array of points to keep.
+    """
+    keep = np.zeros(len(x), dtype=bool)
+    keep[0] = keep[-1] = True
+    segments = [(0, len(x) - 1)]
+    while segments:
+        i, j = segments.pop()
+        if j - i < 2:
+            continue
+        # distance from points between i and j to the segment from i to j
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        px, py = x[i + 1:j] - x[i], y[i + 1:j] - y[i]
+        length = dx * dx + dy * dy
+        u = np.clip((px * dx + py * dy) / length, 0, 1) if length > 0 else 0
+        d = np.hypot(px - u * dx, py - u * dy)
+        k = np.argmax(d)
+        if d[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            segments += [(i, k), (k, j)]
+    return keep
+
+
 # utils
 
+def geodesic(*args, **kwargs):
+    """geopy.distance.geodesic, imported on first use."""
+    from geopy.distance import geodesic
+    return geodesic(*args, **kwargs)
+
+
 def haversine(lat1, lon1, lat2, lon2, earth_radius=6371000):
     """
     Calculate the great circle distance between two points on earth.
@@ -122,6 +255,682 @@ def haversine(lat1, lon1, lat2, lon2, earth_radius=6371000):
         return earth_radius * 2 * np.arcsin(np.sqrt(a))
 
 
+def haversine_distance(a, b):
+    """
+    Haversine distance function of the form: ((lat, lon),(lat, lon)) --> (meters)
+
+    Algorithms working on arrays of points compute this distance vectorized,
+    so it is much faster than geodesic when passed as distf.
+    """
+    return haversine(a[0], a[1], b[0], b[1])
+
+
+def geodesic_distance(a, b):
+    """Geodesic distance function of the form: ((lat, lon),(lat, lon)) --> (meters)"""
+    return geodesic(a, b).meters
+
+
+# distance functions with a vectorized implementation on arrays of coordinates
+_VECTORIZED_DISTANCES = {haversine_distance: haversine}
+
+
+def _distances(distf, lat1, lon1, lat2, lon2):
+    """
+    Compute distances between arrays of points with a distance function.
+
+    Uses the vectorized implementation of distf if there is one, otherwise
+    distf is called for each pair of points.
+
+    :return: array of distances in meters.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(lat1, lon1, lat2, lon2)
+    vectorized = _vectorized_distance(distf)
+    if vectorized is not None:
+        return np.asarray(vectorized(lat1, lon1, lat2, lon2), dtype=float)
+    return np.array([distf((a, b), (c, d)) for a, b, c, d in zip(lat1, lon1, lat2, lon2)],
+                    dtype=float)
+
+
+def _vectorized_distance(distf):
+    """Get the vectorized implementation of a distance function, or None."""
+    if distf in _VECTORIZED_DISTANCES:
+        return _VECTORIZED_DISTANCES[distf]
+    return getattr(distf, 'vectorized', None)
+
+
+def _seconds(datetimes):
+    """Convert an array of datetime64 values to integer seconds."""
+    return datetimes.astype('datetime64[s]').astype(np.int64)
+
+
+# local projection
+
+class LocalProjection:
+    """
+    Distance function on a local metric projection of the points of one user.
+
+    Coordinates are projected to east and north meters around a reference point
+    with an equirectangular projection, where distances are Euclidean. Stages
+    compute these distances vectorized on the projected arrays, and get_places
+    clusters the projected points directly.
+
+    Compared to haversine distances the relative error is at most error_bound
+    for points within extent meters of the reference point, e.g. about 0.5%
+    for points within 25 km of a reference point at latitude 55.
+
+    :param lat0: latitude of the reference point.
+    :param lon0: longitude of the reference point.
+    :param extent: maximum distance in meters between the reference point and the points.
+    """
+
+    EARTH_RADIUS = 6371000
+
+    def __init__(self, lat0, lon0, extent):
+        self.lat0, self.lon0, self.extent = float(lat0), float(lon0), float(extent)
+        self._ky = np.radians(1.0) * self.EARTH_RADIUS  # meters per degree latitude
+        self._kx = self._ky * np.cos(np.radians(self.lat0))  # meters per degree longitude
+
+    def __repr__(self):
+        return 'LocalProjection(%r, %r, %r)' % (self.lat0, self.lon0, self.extent)
+
+    def __call__(self, a, b):
+        return float(np.hypot((a[1] - b[1]) * self._kx, (a[0] - b[0]) * self._ky))
+
+    def vectorized(self, lat1, lon1, lat2, lon2):
+        """Distances between arrays of points."""
+        return np.hypot((np.asarray(lon1) - lon2) * self._kx, (np.asarray(lat1) - lat2) * self._ky)
+
+    def project(self, lat, lon):
+        """
+        Project coordinates to meters east and north of the reference point.
+
+        :return: arrays of x (east) and y (north) in meters.
+        """
+        return (np.asarray(lon, dtype=float) - self.lon0) * self._kx, \
+            (np.asarray(lat, dtype=float) - self.lat0) * self._ky
+
+    @property
+    def error_bound(self):
+        """
+        Maximum relative distance error compared to haversine within extent of the reference.
+
+        East-west distances are scaled by cos(lat0) instead of the cosine of
+        their own latitude, which is the first term. The second term bounds the
+        error of treating the sphere as flat.
+        """
+        h = self.extent / self.EARTH_RADIUS
+        lat0 = np.radians(abs(self.lat0))
+        if lat0 + h >= np.pi / 2:
+            return np.inf
+        scale = max(abs(np.cos(lat0) / np.cos(lat0 + h) - 1),
+                    abs(np.cos(lat0) / np.cos(lat0 - h) - 1))
+        return scale + h ** 2
+
+
+def local_projection(df, max_extent=50000):
+    """
+    Create a local projection distance function for the location points of one user.
+
+    The reference point is the center of the bounding box of the points rounded
+    to 0.1 degree, so it rarely changes when days are added to the data and
+    results cached for earlier days stay valid.
+
+    :param df: dataframe of location points with columns latitude and longitude, or lat and lon.
+    :param max_extent: maximum diagonal of the bounding box of the points in meters.
+    :return: LocalProjection, or geodesic_distance if the bounding box is larger than
+             max_extent or there are no points.
+    """
+    lat = df.latitude.values if 'latitude' in df.columns else df.lat.values
+    lon = df.longitude.values if 'longitude' in df.columns else df.lon.values
+    if not len(lat):
+        return geodesic_distance
+    lat, lon = lat.astype(float), lon.astype(float)
+    lat_min, lat_max, lon_min, lon_max = lat.min(), lat.max(), lon.min(), lon.max()
+    if haversine(lat_min, lon_min, lat_max, lon_max) > max_extent:
+        return geodesic_distance
+    lat0, lon0 = round((lat_min + lat_max) / 2, 1), round((lon_min + lon_max) / 2, 1)
+    extent = max(haversine(lat0, lon0, a, b)
+                 for a in (lat_min, lat_max) for b in (lon_min, lon_max))
+    return LocalProjection(lat0, lon0, extent)
+
+
+def _resolve_distance(distf, df):
+    """Create a local projection for the points if distf is 'local', otherwise return distf."""
+    if isinstance(distf, str):
+        if distf != 'local':
+            raise ValueError('unknown distance function: %s' % distf)
+        return local_projection(df)
+    return distf
+
+
+# kernels
+#
+# Sequential loops over arrays of one user, written in the subset of Python
+# and NumPy that numba compiles. The default 'numpy' backend runs them as they
+# are. The 'numba' backend compiles them on first use and caches the compiled
+# code on disk, which takes seconds the first time and imports numba, so it is
+# only used when requested. Kernels compute haversine distances themselves and
+# return how many they computed, which get_stops reports to counting distance
+# functions.
+
+BACKENDS = ['numpy', 'numba']
+_KERNELS = {}
+
+
+def _kernels(backend='numpy'):
+    """
+    Get the kernels of a backend.
+
+    :param backend: one of BACKENDS.
+    :return: dict of kernel name --> function.
+    """
+    if backend not in _KERNELS:
+        kernels = {'stop_groups': _stop_groups_kernel}
+        if backend == 'numba':
+            import numba
+            kernels = {k: numba.njit(f, error_model='numpy', cache=True)
+                       for k, f in kernels.items()}
+        elif backend != 'numpy':
+            raise ValueError('unknown backend: %s' % backend)
+        _KERNELS[backend] = kernels
+    return _KERNELS[backend]
+
+
+def _stop_groups_kernel(lat, lon, dist, euclidean):
+    """
+    End index of each group of points of get_stops.
+
+    Distances are haversine distances, or Euclidean distances if euclidean is
+    true and lat and lon are projected coordinates.
+
+    :return: array of end indices and number of distances computed.
+    """
+    n = len(lat)
+    ends = np.empty(n, dtype=np.int64)
+    k, i, calls = 0, 0, 0
+    while i < n:
+        j = i + 1
+        c_lat, c_lon = lat[i], lon[i]
+        while j < n:
+            # distance from the centroid to point j
+            if euclidean:
+                d = np.sqrt((lat[j] - c_lat) ** 2 + (lon[j] - c_lon) ** 2)
+            else:
+                lat1, lon1, lat2, lon2 = np.radians(c_lat), np.radians(c_lon), \
+                    np.radians(lat[j]), np.radians(lon[j])
+                a = np.sin((lat2 - lat1) / 2.0) ** 2 + \
+                    np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+                d = 6371000 * 2 * np.arcsin(np.sqrt(a))
+            calls += 1
+            if d > dist:
+                break
+            j += 1
+            c_lat, c_lon = np.median(lat[i:j]), np.median(lon[i:j])
+        ends[k] = j
+        k += 1
+        i = j
+    return ends[:k], calls
+
+
+def _speed_filter(lat, lon, seconds, max_speed):
+    """
+    Mask of points kept by removing points with a speed in of at least max_speed,
+    then points with a speed in or out of at least max_speed until no more
+    points are removed.
+
+    Each pass is vectorized, so compiling it gains nothing and it is not a kernel.
+    """
+    keep = np.ones(len(lat), dtype=np.bool_)
+    first = True
+    while True:
+        idx = np.flatnonzero(keep)
+        n = len(idx)
+        speed_in = np.zeros(n)
+        if n > 1:
+            # haversine distance from the previous point
+            lat1, lon1 = np.radians(lat[idx[1:]]), np.radians(lon[idx[1:]])
+            lat2, lon2 = np.radians(lat[idx[:-1]]), np.radians(lon[idx[:-1]])
+            a = np.sin((lat2 - lat1) / 2.0) ** 2 + \
+                np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.0) ** 2
+            speed = 6371000 * 2 * np.arcsin(np.sqrt(a)) / (seconds[idx[1:]] - seconds[idx[:-1]])
+            speed_in[1:] = np.where(np.isnan(speed), 0.0, speed)
+        drop = speed_in >= max_speed
+        if not first:
+            drop[:-1] |= speed_in[1:] >= max_speed
+            if not drop.any():
+                return keep
+        keep[idx[drop]] = False
+        first = False
+
+
+def _unwrap_distance(distf):
+    """Distance function wrapped by a profiler or tracer."""
+    while hasattr(distf, 'distf'):
+        distf = distf.distf
+    return distf
+
+
+def _count_distances(distf, pairs, start):
+    """
+    Report distances computed by a kernel to the profilers and tracers wrapping distf.
+
+    :param pairs: number of distances computed.
+    :param start: time.perf_counter() when the kernel started.
+    """
+    while hasattr(distf, 'distf'):
+        if hasattr(distf, 'count'):
+            distf.count(pairs, start)
+        distf = distf.distf
+
+
+# profiling
+
+class Profiler:
+    """
+    Record wall time, number of rows and distance function calls of pipeline stages.
+
+    Pass a profiler to preprocess and the stops, places and moves functions to
+    get a record for every stage, user and day. Without a profiler the stages
+    run with no instrumentation.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.distance_calls = 0
+
+    def wrap(self, distf):
+        """Wrap a distance function so its calls are counted by this profiler."""
+        if isinstance(distf, CountingDistance) and distf.profiler is self:
+            return distf
+        return CountingDistance(distf, self)
+
+    @contextmanager
+    def stage(self, name, user_id=None, date=None, rows_in=None):
+        """
+        Context manager recording one run of a stage.
+
+        The record is yielded so the stage can set rows_out.
+
+        :param name: name of the stage.
+        :param user_id: id of the user processed by the stage.
+        :param date: date processed by the stage, None for all dates.
+        :param rows_in: number of input rows.
+        """
+        record = {'stage': name, 'user_id': user_id, 'date': date,
+                  'rows_in': rows_in, 'rows_out': None}
+        calls = self.distance_calls
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            record['distance_calls'] = self.distance_calls - calls
+            self.records.append(record)
+
+    def summary(self):
+        """
+        Summarize records per stage.
+
+        :return: dataframe with total seconds, rows and distance calls per stage.
+        """
+        columns = ['stage', 'runs', 'seconds', 'rows_in', 'rows_out', 'distance_calls']
+        if not self.records:
+            return pd.DataFrame(columns=columns)
+        records = pd.DataFrame(self.records)
+        res = records.groupby('stage', sort=False).agg({
+            'seconds': 'sum',
+            'rows_in': 'sum',
+            'rows_out': 'sum',
+            'distance_calls': 'sum',
+        }).reset_index()
+        res.insert(1, 'runs', records.groupby('stage', sort=False).size().values)
+        return res[columns]
+
+    def to_dict(self):
+        """Return records as a JSON serializable dict."""
+        return {'records': [{k: _json_value(v) for k, v in r.items()} for r in self.records]}
+
+    def to_json(self, path=None):
+        """
+        Export records as JSON.
+
+        :param path: file to write to, or None to return a string.
+        """
+        if path is None:
+            return json.dumps(self.to_dict())
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+
+class CountingDistance:
+    """
+    Distance function counting its calls in a profiler.
+
+    Distances computed on arrays of points count one call per pair of points.
+    """
+
+    def __init__(self, distf, profiler):
+        self.distf = distf
+        self.profiler = profiler
+
+    def __call__(self, a, b):
+        self.profiler.distance_calls += 1
+        return self.distf(a, b)
+
+    def count(self, pairs, start):
+        """Count distances computed without calling the distance function."""
+        self.profiler.distance_calls += pairs
+
+    @property
+    def vectorized(self):
+        vectorized = _vectorized_distance(self.distf)
+        if vectorized is None:
+            return None
+
+        def counted(lat1, lon1, lat2, lon2):
+            self.profiler.distance_calls += np.size(lat1)
+            return vectorized(lat1, lon1, lat2, lon2)
+        return counted
+
+
+class DistanceTracer:
+    """
+    Distance function recording calls, time and call rates per pipeline stage.
+
+    Wrap any distance function and pass the tracer as distf. Each call is
+    attributed to the pipeline function it was made from, such as get_stops or
+    get_places, by walking up the call stack. Distances computed on arrays of
+    points count as one call evaluating many pairs, so the report shows which
+    stages still compute distances one pair at a time.
+
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (meters)
+    :param resolution: length in seconds of the intervals used for call rates.
+    """
+
+    def __init__(self, distf=None, resolution=0.1):
+        self.distf = distf if distf is not None else geodesic_distance
+        self.resolution = resolution
+        self.start = time.perf_counter()
+        # stage --> [calls, pairs, vectorized pairs, seconds]
+        self.stats = {}
+        # stage --> {interval --> pairs}
+        self.rates = {}
+
+    def __call__(self, a, b):
+        start = time.perf_counter()
+        d = self.distf(a, b)
+        self._record(start, 1, False)
+        return d
+
+    def count(self, pairs, start):
+        """Record distances computed on arrays without calling the distance function."""
+        self._record(start, pairs, True)
+
+    @property
+    def vectorized(self):
+        vectorized = _vectorized_distance(self.distf)
+        if vectorized is None:
+            return None
+
+        def traced(lat1, lon1, lat2, lon2):
+            start = time.perf_counter()
+            d = vectorized(lat1, lon1, lat2, lon2)
+            self._record(start, np.size(lat1), True)
+            return d
+        return traced
+
+    def _record(self, start, pairs, vectorized):
+        now = time.perf_counter()
+        stage = _calling_stage(sys._getframe(2))
+        stats = self.stats.setdefault(stage, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += pairs
+        stats[2] += pairs if vectorized else 0
+        stats[3] += now - start
+        rates = self.rates.setdefault(stage, {})
+        interval = int((now - self.start) / self.resolution)
+        rates[interval] = rates.get(interval, 0) + pairs
+
+    def report(self):
+        """
+        Summarize distance calls per stage.
+
+        :return: dataframe with calls, evaluated pairs, share of vectorized pairs,
+                 total seconds and microseconds per pair for each stage.
+        """
+        report = pd.DataFrame(
+            [[stage] + stats for stage, stats in self.stats.items()],
+            columns=['stage', 'calls', 'pairs', 'vectorized', 'seconds'])
+        report['vectorized'] = report.vectorized / report.pairs
+        report['us_per_pair'] = report.seconds / report.pairs * 1e6
+        return report.sort_values('seconds', ascending=False).reset_index(drop=True)
+
+    def rate_histogram(self, stage=None, bins=10):
+        """
+        Histogram of distance evaluation rates while distances were computed.
+
+        :param stage: stage to include, or None for all stages.
+        :param bins: number of histogram bins.
+        :return: tuple of counts of intervals and bin edges in pairs per second.
+        """
+        stages = [stage] if stage is not None else list(self.rates)
+        counts = {}
+        for s in stages:
+            for interval, pairs in self.rates.get(s, {}).items():
+                counts[interval] = counts.get(interval, 0) + pairs
+        return np.histogram(np.array(list(counts.values()), dtype=float) / self.resolution,
+                            bins=bins)
+
+    def reset(self):
+        """Clear recorded calls."""
+        self.start = time.perf_counter()
+        self.stats = {}
+        self.rates = {}
+
+
+def _calling_stage(frame):
+    """Name of the first pipeline stage function on the call stack, or 'other'."""
+    while frame is not None:
+        name = frame.f_code.co_name
+        if name in TRACED_STAGES and frame.f_globals is globals():
+            return name
+        frame = frame.f_back
+    return 'other'
+
+
+class _NoProfiler:
+    """Profiler used when profiling is disabled, records nothing."""
+
+    _stage = nullcontext({})
+
+    def wrap(self, distf):
+        return distf
+
+    def stage(self, name, user_id=None, date=None, rows_in=None):
+        return self._stage
+
+
+_NO_PROFILER = _NoProfiler()
+
+
+def _json_value(v):
+    """Convert numpy and pandas scalars to JSON serializable values."""
+    if isinstance(v, (pd.Timestamp, np.datetime64)):
+        return pd.Timestamp(v).isoformat()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+
+# functions taking a distance function, distance calls are attributed to these by DistanceTracer
+TRACED_STAGES = {
+    'simplify', 'get_stops', 'get_stops_hariharan_toyama', 'get_stops_st_dbscan',
+    'merge_stops', 'get_places', 'get_moves', 'radius_of_gyration', 'std_of_displacements',
+}
+
+
+# shared memory
+
+class SharedPoints:
+    """
+    Columns of location points of many users in one shared memory block.
+
+    Worker processes attach to the block by its spec instead of receiving
+    pickled dataframes. The points of each user are contiguous, so the points
+    of a user, or of one day of a user, are a row range that is read as
+    zero-copy arrays.
+
+    Create the block with publish and attach to it in other processes with
+    attach. Close every instance when done, the publishing instance also
+    removes the block.
+
+    :param shm: SharedMemory block.
+    :param spec: tuple of block name, number of rows, list of (column, dtype),
+                 list of user ids and list of row offsets of the users.
+    :param owner: whether this instance removes the block when closed.
+    """
+
+    # dtype kinds of columns that can be shared: bool, integer, float and datetime
+    KINDS = 'biufM'
+
+    def __init__(self, shm, spec, owner=False):
+        self.shm = shm
+        self.spec = spec
+        self.owner = owner
+        _, self.n, self.columns, self.users, offsets = spec
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._users = {u: i for i, u in enumerate(self.users)}
+        self._layout = _shared_layout(self.n, self.columns)[0]
+
+    @classmethod
+    def publish(cls, df, columns=None):
+        """
+        Copy location points to a new shared memory block.
+
+        :param df: dataframe of location points with a user_id column, where the
+                   points of each user are contiguous.
+        :param columns: columns to share, by default all bool, numeric and datetime
+                        columns except user_id.
+        :return: SharedPoints owning the block.
+        """
+        from multiprocessing import shared_memory
+        shareable = [c for c in df.columns
+                     if isinstance(df[c].dtype, np.dtype) and df[c].dtype.kind in cls.KINDS]
+        if columns is None:
+            columns = [c for c in shareable if c != 'user_id']
+        for c in columns:
+            if c not in shareable:
+                raise ValueError('cannot share column %s of dtype %s' % (c, df[c].dtype))
+        columns = [(c, df[c].dtype.str) for c in columns]
+        users = df.user_id.values
+        starts = np.flatnonzero(np.r_[True, users[1:] != users[:-1]]) if len(df) else []
+        user_ids = users[starts].tolist()
+        if len(set(user_ids)) != len(user_ids):
+            raise ValueError('points of each user must be contiguous')
+        _, size = _shared_layout(len(df), columns)
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        spec = (shm.name, len(df), columns, user_ids, np.r_[starts, len(df)].astype(int).tolist())
+        points = cls(shm, spec, owner=True)
+        for c, dtype in columns:
+            points._column(c, dtype)[:] = df[c].values
+        return points
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        Attach to a block published by another process.
+
+        :param spec: spec of the publishing SharedPoints.
+        :return: SharedPoints reading the block.
+        """
+        from multiprocessing import shared_memory
+        return cls(shared_memory.SharedMemory(spec[0]), spec)
+
+    def __len__(self):
+        return self.n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Detach from the block, arrays returned by arrays must not be used afterwards."""
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def user_range(self, user_id):
+        """Start and stop row of the points of a user."""
+        i = self._users[user_id]
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def days(self, user_id):
+        """
+        Row ranges of the days of a user, the points need a date column.
+
+        :param user_id: id of the user.
+        :return: list of (date, start, stop) in the order of the points.
+        """
+        start, stop = self.user_range(user_id)
+        dates = self.arrays(start, stop, ['date'])['date']
+        starts = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1]])
+        return [(pd.Timestamp(dates[i]), start + i, start + j)
+                for i, j in zip(starts, np.r_[starts[1:], len(dates)])]
+
+    def arrays(self, start=0, stop=None, columns=None):
+        """
+        Zero-copy views of a row range.
+
+        :param start: first row.
+        :param stop: row after the last row, defaults to the number of rows.
+        :param columns: columns to return, defaults to all columns.
+        :return: dict of column --> array.
+        """
+        stop = self.n if stop is None else stop
+        dtypes = dict(self.columns)
+        return {c: self._column(c, dtypes[c])[start:stop]
+                for c in (columns if columns is not None else dtypes)}
+
+    def frame(self, start=0, stop=None):
+        """
+        Copy a row range of the points of one user to a dataframe.
+
+        :return: dataframe with a user_id column followed by the shared columns.
+        """
+        df = pd.DataFrame({c: a.copy() for c, a in self.arrays(start, stop).items()})
+        df.insert(0, 'user_id', self.users[np.searchsorted(self.offsets, start, 'right') - 1]
+                  if self.users else None)
+        return df
+
+    def user_frame(self, user_id):
+        """Copy the points of a user to a dataframe."""
+        return self.frame(*self.user_range(user_id))
+
+    def _column(self, c, dtype):
+        return np.ndarray(self.n, dtype=dtype, buffer=self.shm.buf, offset=self._layout[c])
+
+
+def _shared_layout(n, columns):
+    """Byte offsets of columns in a shared memory block aligned to 8 bytes, and its size."""
+    offsets, size = {}, 0
+    for c, dtype in columns:
+        offsets[c] = size
+        size += -(-n * np.dtype(dtype).itemsize // 8) * 8
+    return offsets, size
+
+
+# state of a worker process, set by _init_worker
+_WORKER = {}
+
+
+def _init_worker(spec, state):
+    """Attach a worker process to shared location points and keep the state of its tasks."""
+    _WORKER.clear()
+    _WORKER.update(state, points=SharedPoints.attach(spec))
+
+
 # stops, places and moves
 
 """
@@ -142,11 +951,16 @@ departure and arrival time, origin and destination place and the distance of
 the move.
 """
 
+# columns identifying the location points of a user in cache keys
+_POINT_COLUMNS = ['user_id', 'datetime', 'lat', 'lon']
+
 
 def get_stops_places_and_moves(df, stop_duration=15, stop_dist=25,
                                place_dist=25, move_duration=5, move_dist=50,
                                merge=True, merge_dist=25, merge_time=5,
-                               distf=lambda a, b: geodesic(a, b).meters):
+                               distf=geodesic_distance,
+                               stop_algorithm='distance_grouping', cache=None, profiler=None,
+                               backend='numpy'):
     """
     Extract stops, places and moves for one user.
 
@@ -160,7 +974,14 @@ def get_stops_places_and_moves(df, stop_duration=15, stop_dist=25,
     :param place_dist: maximum distance between stops in a cluster specified in meters.
     :param move_duration: minimum duration of a move measured in minutes.
     :param move_dist: minimum distance of a move measured in meters.
-    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters)
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters),
+                  or 'local' for the local_projection of the points of the user.
+    :param stop_algorithm: name of a stop detection algorithm in STOP_ALGORITHMS or a function
+                           with the same signature as get_stops.
+    :param cache: optional ResultCache for reusing results of previous calls.
+    :param profiler: optional Profiler recording time, rows and distance calls of each stage.
+    :param backend: backend of the grouping kernel of the distance_grouping algorithm,
+                    one of BACKENDS, see get_stops.
     :return: dataframe of labeled stops, dataframe of clusters and dataframe of moves.
     """
     REQUIRED_COLUMNS = ['user_id', 'datetime', 'longitude', 'latitude']
@@ -170,28 +991,46 @@ def get_stops_places_and_moves(df, stop_duration=15, stop_dist=25,
     # prepare data
     df = df.rename(columns={'latitude': 'lat', 'longitude': 'lon'})
     df = df.sort_values(by='datetime')
+    distf = _resolve_distance(distf, df)
+    # reuse the result of a previous call with the same data and parameters
+    if cache is not None:
+        key = cache.key('stops_places_and_moves', cache.hash_frame(df[_POINT_COLUMNS]),
+                        stop_duration, stop_dist, place_dist, move_duration, move_dist,
+                        merge, merge_dist, merge_time, distf, stop_algorithm, backend)
+        result = cache.get(key)
+        if result is not None:
+            return result
     # extract stops, places and moves
-    stops = get_stops(df, stop_duration, stop_dist, distf)
-    if merge and len(stops) > 1:
-        stops = merge_stops(stops, merge_dist, merge_time, distf)
-    stops, places = get_places(stops, place_dist, distf)
-    moves = get_moves(df, stops, move_duration, move_dist, distf)
+    profiler = profiler if profiler is not None else _NO_PROFILER
+    distf = profiler.wrap(distf)
+    stops = _get_stops_stage(df, stop_duration, stop_dist, merge, merge_dist, merge_time,
+                             distf, stop_algorithm, cache, profiler=profiler, backend=backend)
+    stops, places = _get_places_stage(stops, place_dist, distf, profiler)
+    with profiler.stage('get_moves', df.user_id.values[0], rows_in=len(df)) as record:
+        moves = get_moves(df, stops, move_duration, move_dist, distf)
+        record['rows_out'] = len(moves)
     # rename columns
     stops.rename(columns={'lat': 'latitude', 'lon': 'longitude'}, inplace=True)
     places.rename(columns={'lat': 'latitude', 'lon': 'longitude'}, inplace=True)
     moves.rename(columns={'from_lat': 'from_latitude', 'from_lon': 'from_longitude',
                  'to_lat': 'to_latitude', 'to_lon': 'to_longitude'}, inplace=True)
+    if cache is not None:
+        cache.put(key, (stops, places, moves))
     return stops, places, moves
 
 
 def get_stops_places_and_moves_daily(df, stop_duration=15, stop_dist=25,
                                      place_dist=25, move_duration=5, move_dist=50,
                                      merge=True, merge_dist=25, merge_time=5,
-                                     distf=lambda a, b: geodesic(a, b).meters):
+                                     distf=geodesic_distance,
+                                     stop_algorithm='distance_grouping', cache=None,
+                                     profiler=None, n_jobs=1, backend='numpy'):
     """
     Extract stops, places and moves for one user.
 
     Assume multiple days of data and group by date when extracting stops and moves.
+    Stops and moves of different days are independent, so with n_jobs > 1 they
+    are computed by worker processes, see _get_days_parallel.
 
     1. Compute stops as spatio-temporal groups of location samples.
     2. Compute places by clustering stops based only on spatial location.
@@ -203,42 +1042,325 @@ def get_stops_places_and_moves_daily(df, stop_duration=15, stop_dist=25,
     :param place_dist: maximum distance between stops in a cluster specified in meters.
     :param move_duration: minimum duration of a move measured in minutes.
     :param move_dist: minimum distance of a move measured in meters.
-    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters)
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters),
+                  or 'local' for the local_projection of the points of the user.
+    :param stop_algorithm: name of a stop detection algorithm in STOP_ALGORITHMS or a function
+                           with the same signature as get_stops.
+    :param cache: optional ResultCache for reusing results of previous calls.
+    :param profiler: optional Profiler recording time, rows and distance calls of each stage.
+    :param n_jobs: number of worker processes computing stops and moves of days in parallel.
+    :param backend: backend of the grouping kernel of the distance_grouping algorithm,
+                    one of BACKENDS, see get_stops.
     :return: dataframe of labeled stops, dataframe of clusters and dataframe of moves.
     """
     REQUIRED_COLUMNS = ['user_id', 'datetime', 'date', 'longitude', 'latitude']
     # validate input
     assert all(c in df.columns for c in REQUIRED_COLUMNS)
     assert df.user_id.nunique() == 1
+    assert n_jobs > 0
     # prepare data
     df = df.rename(columns={'latitude': 'lat', 'longitude': 'lon'})
     df = df.sort_values(by='datetime')
+    distf = _resolve_distance(distf, df)
+    # reuse the result of a previous call with the same data and parameters
+    day_keys = {}
+    if cache is not None:
+        # fingerprint each day once, unchanged days reuse their cached stops and moves
+        day_keys = cache.fingerprint_days(df, _POINT_COLUMNS)
+        key = cache.key('stops_places_and_moves_daily', sorted(day_keys.items()),
+                        stop_duration, stop_dist, place_dist, move_duration, move_dist,
+                        merge, merge_dist, merge_time, distf, stop_algorithm, backend)
+        result = cache.get(key)
+        if result is not None:
+            return result
     # extract stops, places and moves
-    stops = df.groupby('date') \
-              .apply(lambda d: get_stops(d, stop_duration, stop_dist, distf)) \
-              .reset_index(level=0).reset_index(drop=True)
+    profiler = profiler if profiler is not None else _NO_PROFILER
+    if n_jobs > 1 and df.date.nunique() > 1:
+        stops, places, moves = _get_days_parallel(
+            df, stop_duration, stop_dist, place_dist, move_duration, move_dist, merge,
+            merge_dist, merge_time, distf, stop_algorithm, cache, day_keys, profiler, n_jobs,
+            backend)
+    else:
+        distf = profiler.wrap(distf)
+        stops = _get_daily_stops(df, stop_duration, stop_dist, merge, merge_dist, merge_time,
+                                 distf, stop_algorithm, cache, day_keys, profiler, backend)
+        # places are clustered over the stops of all days
+        stops, places = _get_places_stage(stops, place_dist, distf, profiler)
+        moves = _get_daily_moves(df, stops, move_duration, move_dist, distf, cache, day_keys,
+                                 profiler)
+    stops, places, moves = _result_columns(stops), _result_columns(places), _result_columns(moves)
+    if cache is not None:
+        cache.put(key, (stops, places, moves))
+    return stops, places, moves
+
+
+def _get_daily_stops(df, stop_duration, stop_dist, merge, merge_dist, merge_time, distf,
+                     stop_algorithm='distance_grouping', cache=None, day_keys=None,
+                     profiler=_NO_PROFILER, backend='numpy'):
+    """
+    Compute stops of each day with _get_stops_stage.
+
+    :param df: dataframe of location points of one user sorted chronologically.
+    :param day_keys: dict of date --> hash of the points of the day,
+                     from ResultCache.fingerprint_days.
+    :return: dataframe of stops with a date column.
+    """
+    day_keys = day_keys if day_keys is not None else {}
+    return df.groupby('date') \
+             .apply(lambda d: _get_stops_stage(d, stop_duration, stop_dist, merge, merge_dist,
+                                               merge_time, distf, stop_algorithm, cache,
+                                               day_keys.get(d.name), profiler, backend)) \
+             .reset_index(level=0).reset_index(drop=True)
+
+
+def _get_daily_moves(df, stops, move_duration, move_dist, distf, cache=None, day_keys=None,
+                     profiler=_NO_PROFILER):
+    """
+    Compute moves of each day with _get_moves_stage.
+
+    :param df: dataframe of location points of one user sorted chronologically.
+    :param stops: dataframe of labeled stops of all days.
+    :param day_keys: dict of date --> hash of the points of the day,
+                     from ResultCache.fingerprint_days.
+    :return: dataframe of moves with a date column.
+    """
+    day_keys = day_keys if day_keys is not None else {}
+    return df.groupby('date') \
+             .apply(lambda d: _get_moves_stage(d, stops, move_duration, move_dist, distf, cache,
+                                               day_keys.get(d.name), profiler)) \
+             .reset_index(level=0).reset_index(drop=True)
+
+
+def _result_columns(df):
+    """Move user_id to the first column of a result and rename its coordinate columns."""
+    if 'user_id' in df.columns:
+        df = df[['user_id'] + [c for c in df.columns if not c == 'user_id']]
+    return df.rename(columns={'lat': 'latitude', 'lon': 'longitude',
+                              'from_lat': 'from_latitude', 'from_lon': 'from_longitude',
+                              'to_lat': 'to_latitude', 'to_lon': 'to_longitude'})
+
+
+def _get_stops_stage(df, stop_duration, stop_dist, merge, merge_dist, merge_time, distf,
+                     stop_algorithm='distance_grouping', cache=None, points_key=None,
+                     profiler=_NO_PROFILER, backend='numpy'):
+    """
+    Compute stops and optionally merge them, reusing cached stops if possible.
+
+    Stops only depend on the location points and the stop and merge parameters,
+    so cached stops are reused when only place or move parameters change.
+
+    :param df: dataframe of location points sorted chronologically with columns:
+               user_id, datetime, lat, lon.
+    :param stop_algorithm: name of a stop detection algorithm or a stop detection function.
+    :param cache: optional ResultCache.
+    :param points_key: hash of the location points, computed if not given.
+    :param profiler: Profiler recording the stop and merge stages.
+    :param backend: backend of get_stops, passed if stop_algorithm is get_stops.
+    :return: dataframe of stops.
+    """
+    if cache is not None:
+        key = _stops_key(cache, df, points_key, stop_duration, stop_dist, merge, merge_dist,
+                         merge_time, distf, stop_algorithm, backend)
+        stops = cache.get(key)
+        if stops is not None:
+            return stops
+    user_id, date = df.user_id.values[0], _date_of(df)
+    with profiler.stage('get_stops', user_id, date, rows_in=len(df)) as record:
+        algorithm = _get_stop_algorithm(stop_algorithm)
+        kwargs = {'backend': backend} if algorithm is get_stops else {}
+        stops = algorithm(df, stop_duration, stop_dist, distf, **kwargs)
+        record['rows_out'] = len(stops)
     if merge and len(stops) > 1:
-        stops = stops.groupby('date') \
-                     .apply(lambda d: merge_stops(d, merge_dist, merge_time, distf)) \
-                     .reset_index(drop=True)
-    stops, places = get_places(stops, place_dist, distf)
-    moves = df.groupby('date') \
-              .apply(lambda d: get_moves(d, stops, move_duration, move_dist, distf)) \
-              .reset_index(level=0).reset_index(drop=True)
-    # ensure user_id is first column after groupby date
-    if 'user_id' in stops.columns:
-        stops = stops[['user_id'] + [c for c in stops.columns if not c == 'user_id']]
-    if 'user_id' in moves.columns:
-        moves = moves[['user_id'] + [c for c in moves.columns if not c == 'user_id']]
-    # rename columns
-    stops.rename(columns={'lat': 'latitude', 'lon': 'longitude'}, inplace=True)
-    places.rename(columns={'lat': 'latitude', 'lon': 'longitude'}, inplace=True)
-    moves.rename(columns={'from_lat': 'from_latitude', 'from_lon': 'from_longitude',
-                 'to_lat': 'to_latitude', 'to_lon': 'to_longitude'}, inplace=True)
+        with profiler.stage('merge_stops', user_id, date, rows_in=len(stops)) as record:
+            stops = merge_stops(stops, merge_dist, merge_time, distf)
+            record['rows_out'] = len(stops)
+    if cache is not None:
+        cache.put(key, stops)
+    return stops
+
+
+def _get_moves_stage(df, stops, move_duration, move_dist, distf, cache=None, points_key=None,
+                     profiler=_NO_PROFILER):
+    """
+    Compute moves of one day, reusing cached moves if possible.
+
+    Moves of a day only depend on its location points and the labeled stops of
+    the same day, so they are reused unless the day or its place labels change.
+
+    :param df: dataframe of location points of one day sorted chronologically.
+    :param stops: dataframe of labeled stops with columns: date, arrival, departure, place.
+    :param cache: optional ResultCache.
+    :param points_key: hash of the location points, computed if not given.
+    :param profiler: Profiler recording the move stage.
+    :return: dataframe of moves.
+    """
+    if cache is not None:
+        key = _moves_key(cache, df, stops, points_key, move_duration, move_dist, distf)
+        moves = cache.get(key)
+        if moves is not None:
+            return moves
+    with profiler.stage('get_moves', df.user_id.values[0], _date_of(df),
+                        rows_in=len(df)) as record:
+        moves = get_moves(df, stops, move_duration, move_dist, distf)
+        record['rows_out'] = len(moves)
+    if cache is not None:
+        cache.put(key, moves)
+    return moves
+
+
+def _stops_key(cache, df, points_key, stop_duration, stop_dist, merge, merge_dist, merge_time,
+               distf, stop_algorithm, backend='numpy'):
+    """Cache key of the stops of one day."""
+    if points_key is None:
+        points_key = cache.hash_frame(df[_POINT_COLUMNS])
+    return cache.key('stops', points_key,
+                     stop_duration, stop_dist, merge, merge_dist, merge_time, distf,
+                     stop_algorithm, backend)
+
+
+def _moves_key(cache, df, stops, points_key, move_duration, move_dist, distf):
+    """Cache key of the moves of one day, depending on the labeled stops of the day."""
+    if points_key is None:
+        points_key = cache.hash_frame(df[_POINT_COLUMNS])
+    day_stops = stops[stops.date == df.date.values[0]]
+    return cache.key('moves', points_key,
+                     cache.hash_frame(day_stops[['arrival', 'departure', 'place']]),
+                     move_duration, move_dist, distf)
+
+
+def _get_places_stage(stops, place_dist, distf, profiler=_NO_PROFILER):
+    """Compute places with get_places, recorded by the profiler."""
+    user_id = stops.user_id.values[0] if 'user_id' in stops.columns and len(stops) else None
+    with profiler.stage('get_places', user_id, rows_in=len(stops)) as record:
+        stops, places = get_places(stops, place_dist, distf)
+        record['rows_out'] = len(places)
+    return stops, places
+
+
+def _date_of(df):
+    """Date of location points of one day, None if the points have no date column."""
+    return df.date.values[0] if 'date' in df.columns and len(df) else None
+
+
+# parallel days
+#
+# The location points of the user are published once in SharedPoints. Worker
+# processes attach to it when they start and copy the points of a day from
+# its row range, so a task only sends the date and row range of the day, and
+# for moves the few labeled stops of the day.
+
+def _day_stops(date, start, stop, stop_duration, stop_dist, merge, merge_dist, merge_time):
+    """Compute the stops of one day in a worker process."""
+    w = _WORKER
+    profiler = Profiler() if w['profile'] else _NO_PROFILER
+    stops = _get_stops_stage(w['points'].frame(start, stop), stop_duration, stop_dist, merge,
+                             merge_dist, merge_time, profiler.wrap(w['distf']),
+                             w['stop_algorithm'], profiler=profiler, backend=w['backend'])
+    return stops, profiler
+
+
+def _day_moves(date, start, stop, stops, move_duration, move_dist):
+    """Compute the moves of one day in a worker process."""
+    w = _WORKER
+    profiler = Profiler() if w['profile'] else _NO_PROFILER
+    moves = _get_moves_stage(w['points'].frame(start, stop), stops, move_duration, move_dist,
+                             profiler.wrap(w['distf']), profiler=profiler)
+    return moves, profiler
+
+
+def _get_days_parallel(df, stop_duration, stop_dist, place_dist, move_duration, move_dist,
+                       merge, merge_dist, merge_time, distf, stop_algorithm, cache, day_keys,
+                       profiler, n_jobs, backend='numpy'):
+    """
+    Compute stops, places and moves of one user with days processed by worker processes.
+
+    Days found in the cache are reused in this process and only the others are
+    sent to workers. Places are clustered in this process over the stops of all
+    days, before the moves of the days are computed.
+
+    Workers see the numeric and datetime columns of the location points.
+    Records of worker stages are added to the profiler, calls
+    recorded by a DistanceTracer in a worker are lost.
+
+    :param df: dataframe of location points of one user sorted chronologically with columns:
+               user_id, date, datetime, lat, lon.
+    :param day_keys: dict of date --> hash of the points of the day,
+                     from ResultCache.fingerprint_days.
+    :param profiler: Profiler or _NO_PROFILER.
+    :param n_jobs: number of worker processes.
+    :param backend: backend of get_stops, see _get_stops_stage.
+    :return: dataframe of labeled stops, dataframe of clusters and dataframe of moves.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    if multiprocessing.get_start_method() != 'fork':
+        # forked workers inherit functions, other workers unpickle them
+        try:
+            pickle.dumps((distf, stop_algorithm))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            raise ValueError('n_jobs > 1 needs a distance function and stop algorithm that '
+                             'can be pickled, such as geodesic_distance')
+    profile = not isinstance(profiler, _NoProfiler)
+    points = SharedPoints.publish(df)
+    try:
+        days = points.days(df.user_id.values[0])
+        state = {'distf': distf, 'stop_algorithm': stop_algorithm, 'backend': backend,
+                 'profile': profile}
+        with ProcessPoolExecutor(min(n_jobs, len(days)), initializer=_init_worker,
+                                 initargs=(points.spec, state)) as executor:
+            distf = profiler.wrap(distf)
+            keys = {}
+            if cache is not None:
+                keys = {date: _stops_key(cache, None, day_keys[date], stop_duration, stop_dist,
+                                         merge, merge_dist, merge_time, distf, stop_algorithm,
+                                         backend)
+                        for date, _, _ in days}
+            stops = _map_days(executor, days, keys, cache, profiler, _day_stops,
+                              lambda date: (stop_duration, stop_dist, merge, merge_dist,
+                                            merge_time))
+            # places are clustered over the stops of all days
+            stops, places = _get_places_stage(stops, place_dist, distf, profiler)
+            if cache is not None:
+                keys = {date: _moves_key(cache, df.iloc[start:stop], stops, day_keys[date],
+                                         move_duration, move_dist, distf)
+                        for date, start, stop in days}
+            moves = _map_days(executor, days, keys, cache, profiler, _day_moves,
+                              lambda date: (stops[stops.date == date], move_duration, move_dist))
+    finally:
+        points.close()
     return stops, places, moves
 
 
-def get_stops(df, min_duration, dist, distf):
+def _map_days(executor, days, keys, cache, profiler, task, args):
+    """
+    Run a day task in worker processes for all days not in the cache.
+
+    :param days: list of (date, start, stop).
+    :param keys: dict of date --> cache key, empty without cache.
+    :param task: function of (date, start, stop, *args) returning a dataframe and a profiler.
+    :param args: function of a date returning the other arguments of the task.
+    :return: dataframe of the results of all days with a date column.
+    """
+    results, futures = {}, {}
+    for date, start, stop in days:
+        result = cache.get(keys[date]) if cache is not None else None
+        if result is not None:
+            results[date] = result
+        else:
+            futures[date] = executor.submit(task, date, start, stop, *args(date))
+    for date, future in futures.items():
+        results[date], worker_profiler = future.result()
+        if cache is not None:
+            cache.put(keys[date], results[date])
+        if isinstance(worker_profiler, Profiler):
+            profiler.records.extend(worker_profiler.records)
+            profiler.distance_calls += worker_profiler.distance_calls
+    dates = [date for date, _, _ in days]
+    return pd.concat([results[date] for date in dates], keys=dates, names=['date']) \
+             .reset_index(level=0).reset_index(drop=True)
+
+
+def get_stops(df, min_duration, dist, distf, backend='numpy'):
     """
     Compute stops for one user with distance grouping algorithm.
 
@@ -252,8 +1374,21 @@ def get_stops(df, min_duration, dist, distf):
     :param min_duration: minimum duration of a stop measured in minutes.
     :param dist: maximum distance between points and the median point in a stop.
     :param distf: distance function of the form: ((lat,lon),(lat,lon)) --> (meters)
+    :param backend: backend of the grouping kernel used with haversine_distance and
+                    LocalProjection, one of BACKENDS.
     :return: dataframe of stops.
     """
+    base = _unwrap_distance(distf)
+    if len(df) and (base is haversine_distance or isinstance(base, LocalProjection)):
+        lat, lon = df.lat.values.astype(float), df.lon.values.astype(float)
+        euclidean = isinstance(base, LocalProjection)
+        if euclidean:
+            lon, lat = base.project(lat, lon)
+        start = time.perf_counter()
+        ends, calls = _kernels(backend)['stop_groups'](lat, lon, float(dist), euclidean)
+        _count_distances(distf, calls, start)
+        groups = np.repeat(np.arange(len(ends)), np.diff(np.r_[0, ends]))
+        return _stops_from_groups(df, groups, min_duration)
     stops = []
     i, N = 0, len(df)
     while i < N:
@@ -264,7 +1399,7 @@ def get_stops(df, min_duration, dist, distf):
             j += 1
             g = df.iloc[i:j]
             c = (g.lat.median(), g.lon.median())
-        stops.append([c[0], c[1], g.shape[0], g.datetime.values[0], g.datetime.values[-1]])
+        stops.append([c[0], c[1], _samples(g), g.datetime.values[0], g.datetime.values[-1]])
         i = j
     stops = pd.DataFrame(stops, columns=['lat', 'lon', 'samples', 'arrival', 'departure'])
     stops.insert(0, 'user_id', df.user_id.values[0])
@@ -274,7 +1409,148 @@ def get_stops(df, min_duration, dist, distf):
     return stops
 
 
-def merge_stops(stops, dist=50, time=5, distf=lambda a, b: geodesic(a, b).meters):
+def get_stops_hariharan_toyama(df, min_duration, dist, distf, window=16):
+    """
+    Compute stops for one user with a time-first stay point algorithm.
+
+    Based on the stay extraction of Hariharan and Toyama (2004). A stop is
+    anchored at a location point and extends to the last point before the first
+    point farther than dist from the anchor. If the stop lasts at least
+    min_duration it is kept and the search continues after it, otherwise the
+    search continues from the next point. Distances from the anchor are computed
+    on arrays of points in growing windows.
+
+    :param df: dataframe of location points sorted chronologically with columns:
+               user_id, datetime, lat, lon.
+    :param min_duration: minimum duration of a stop measured in minutes.
+    :param dist: maximum distance between the first point and all other points in a stop.
+    :param distf: distance function of the form: ((lat,lon),(lat,lon)) --> (meters)
+    :param window: initial number of points compared to the anchor at a time.
+    :return: dataframe of stops.
+    """
+    lat, lon = df.lat.values, df.lon.values
+    t = _seconds(df.datetime.values)
+    groups = np.full(len(df), -1)
+    i, g, N = 0, 0, len(df)
+    while i < N:
+        j = _first_point_outside(lat, lon, i, dist, distf, window)
+        if t[j - 1] - t[i] >= min_duration * 60:
+            groups[i:j] = g
+            g += 1
+            i = j
+        else:
+            i += 1
+    return _stops_from_groups(df, groups, min_duration)
+
+
+def get_stops_st_dbscan(df, min_duration, dist, distf, time_dist=5, min_samples=3):
+    """
+    Compute stops for one user with a spatio-temporal DBSCAN algorithm.
+
+    Location points are neighbours if they are within dist meters and time_dist
+    minutes of each other. Neighbours are found on the diagonals of the time
+    ordered points and clustered with DBSCAN. A stop is a run of consecutive
+    points in the same cluster, points labeled as noise are ignored.
+
+    :param df: dataframe of location points sorted chronologically with columns:
+               user_id, datetime, lat, lon.
+    :param min_duration: minimum duration of a stop measured in minutes.
+    :param dist: maximum distance between neighbouring points in meters.
+    :param distf: distance function of the form: ((lat,lon),(lat,lon)) --> (meters)
+    :param time_dist: maximum time between neighbouring points in minutes.
+    :param min_samples: minimum number of neighbours of a core point.
+    :return: dataframe of stops.
+    """
+    lat, lon = df.lat.values, df.lon.values
+    t = _seconds(df.datetime.values)
+    N = len(df)
+    groups = np.full(N, -1)
+    if N == 0:
+        return _stops_from_groups(df, groups, min_duration)
+    # largest offset between points within time_dist of each other
+    K = (np.searchsorted(t, t + time_dist * 60, side='right') - np.arange(N) - 1).max()
+    rows, cols, data = [np.arange(0)], [np.arange(0)], [np.arange(0.0)]
+    for k in range(1, K + 1):
+        a = np.arange(N - k)
+        a = a[t[a + k] - t[a] <= time_dist * 60]
+        d = _distances(distf, lat[a], lon[a], lat[a + k], lon[a + k])
+        near = d <= dist
+        rows.append(a[near])
+        cols.append(a[near] + k)
+        data.append(d[near])
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    # add a small constant so identical points are stored as neighbours in the sparse matrix
+    data = np.concatenate(data) + 1e-9
+    from scipy.sparse import csr_matrix
+    from sklearn.cluster import DBSCAN
+    graph = csr_matrix((np.r_[data, data], (np.r_[rows, cols], np.r_[cols, rows])), shape=(N, N))
+    with warnings.catch_warnings():
+        # DBSCAN warns that the rows of the sparse graph are not sorted by distance
+        warnings.simplefilter("ignore")
+        dbs = DBSCAN(dist + 1e-9, min_samples=min_samples, metric='precomputed').fit(graph)
+    labels = dbs.labels_
+    # split clusters into runs of consecutive points with the same label
+    clustered = np.flatnonzero(labels >= 0)
+    runs = labels[clustered]
+    groups[clustered] = np.cumsum(np.r_[True, runs[1:] != runs[:-1]]) - 1
+    return _stops_from_groups(df, groups, min_duration)
+
+
+def _first_point_outside(lat, lon, i, dist, distf, window):
+    """Index of the first point after point i farther than dist from point i, or N."""
+    start, N = i + 1, len(lat)
+    while start < N:
+        stop = min(start + window, N)
+        outside = np.flatnonzero(
+            _distances(distf, lat[i], lon[i], lat[start:stop], lon[start:stop]) > dist)
+        if len(outside) > 0:
+            return start + outside[0]
+        start = stop
+        window *= 2
+    return N
+
+
+def _stops_from_groups(df, groups, min_duration):
+    """
+    Create stops from a group label for each location point.
+
+    :param df: dataframe of location points sorted chronologically.
+    :param groups: array of stop labels in increasing order, -1 for points not in a stop.
+    :param min_duration: minimum duration of a stop measured in minutes.
+    :return: dataframe of stops with the same columns as get_stops.
+    """
+    g = df[groups >= 0].groupby(groups[groups >= 0])
+    stops = pd.DataFrame({
+        'lat': g.lat.median(),
+        'lon': g.lon.median(),
+        'samples': g.weight.sum() if 'weight' in df.columns else g.size(),
+        'arrival': g.datetime.first(),
+        'departure': g.datetime.last(),
+    }, columns=['lat', 'lon', 'samples', 'arrival', 'departure']).reset_index(drop=True)
+    stops.insert(0, 'user_id', df.user_id.values[0])
+    stops['duration'] = (stops.departure - stops.arrival).dt.total_seconds() / 60
+    stops = stops[stops.duration >= min_duration]
+    stops.reset_index(drop=True, inplace=True)
+    return stops
+
+
+# stop detection algorithms selectable by name in the pipeline functions
+STOP_ALGORITHMS = {
+    'distance_grouping': get_stops,
+    'hariharan_toyama': get_stops_hariharan_toyama,
+    'st_dbscan': get_stops_st_dbscan,
+}
+
+
+def _get_stop_algorithm(stop_algorithm):
+    """Get a stop detection function by name or return a given function."""
+    if callable(stop_algorithm):
+        return stop_algorithm
+    assert stop_algorithm in STOP_ALGORITHMS, 'unknown stop algorithm: %s' % stop_algorithm
+    return STOP_ALGORITHMS[stop_algorithm]
+
+
+def merge_stops(stops, dist=50, time=5, distf=geodesic_distance):
     """
     Merge stops that are close in time and space and have no stops between.
 
@@ -286,32 +1562,23 @@ def merge_stops(stops, dist=50, time=5, distf=lambda a, b: geodesic(a, b).meters
     """
     if len(stops) < 2:
         return stops  # nothing to merge
-    stops = stops.copy()
-    # compute delta columns
-    stops['lat1'], stops['lon1'] = stops.lat.shift().bfill(), stops.lon.shift().bfill()
-    stops['delta_meters'] = stops.apply(lambda r: distf((r.lat, r.lon), (r.lat1, r.lon1)), axis=1)
-    stops['delta_seconds'] = (stops['arrival'] - stops['departure'].shift()) \
-        .dt.total_seconds().fillna(0)
-    # create merge identifier
-    stops['merge'] = stops.index.values
-    stops.loc[(stops.delta_meters <= dist) & (stops.delta_seconds <= time * 60), 'merge'] = np.nan
-    stops['merge'].values[0] = stops.index.values[0]
-    stops['merge'] = stops['merge'].ffill()
-
-    # merge group of stops to one stop
-    def merge(g):
-        r = g.iloc[0].copy()
-        r.lat = g.lat.mean()
-        r.lon = g.lon.mean()
-        r.samples = g.samples.sum()
-        r.departure = g.iloc[-1].departure
-        r.duration = (r.departure - r.arrival).total_seconds() / 60
-        return r
-
-    stops = stops.groupby('merge').apply(merge).reset_index(drop=True)
-    # cleanup and return
-    stops.drop(columns=['lat1', 'lon1', 'delta_meters', 'delta_seconds', 'merge'], inplace=True)
-    return stops
+    stops = stops.reset_index(drop=True)
+    lat, lon = stops.lat.values.astype(float), stops.lon.values.astype(float)
+    # a stop is merged with the previous stop if it is close in space and time
+    delta_meters = _distances(distf, lat[1:], lon[1:], lat[:-1], lon[:-1])
+    delta_seconds = _seconds(stops.arrival.values[1:]) - _seconds(stops.departure.values[:-1])
+    first = np.r_[True, (delta_meters > dist) | (delta_seconds > time * 60)]
+    starts = np.flatnonzero(first)
+    ends = np.r_[starts[1:], len(stops)]
+    # merged stops keep the columns of their first stop
+    merged = stops.iloc[starts].reset_index(drop=True)
+    counts = ends - starts
+    merged['lat'] = np.add.reduceat(lat, starts) / counts
+    merged['lon'] = np.add.reduceat(lon, starts) / counts
+    merged['samples'] = np.add.reduceat(stops.samples.values, starts)
+    merged['departure'] = stops.departure.values[ends - 1]
+    merged['duration'] = (merged.departure - merged.arrival).dt.total_seconds() / 60
+    return merged
 
 
 def get_places(stops, dist, distf):
@@ -329,8 +1596,13 @@ def get_places(stops, dist, distf):
         stops['place'] = []
         places = pd.DataFrame(columns=['user_id', 'place', 'lat', 'lon', 'duration', 'stops'])
     else:
-        points = stops[['lat', 'lon']].values
-        dbs = DBSCAN(dist, min_samples=1, metric=distf).fit(points)
+        from sklearn.cluster import DBSCAN
+        base = _unwrap_distance(distf)
+        if isinstance(base, LocalProjection):
+            # cluster projected points with Euclidean distances
+            dbs = DBSCAN(dist, min_samples=1).fit(np.c_[base.project(stops.lat, stops.lon)])
+        else:
+            dbs = DBSCAN(dist, min_samples=1, metric=distf).fit(stops[['lat', 'lon']].values)
         stops['place'] = dbs.labels_
         places = stops.groupby('place').agg({
             'lat': np.median,
@@ -364,7 +1636,7 @@ def get_moves(df, stops, min_duration, min_dist, distf):
         g = df[(df.datetime >= departure) & (df.datetime <= stop.arrival)]
         if not g.empty:
             moves.append([g.lat.values[0], g.lon.values[0],
-                          g.lat.values[-1], g.lon.values[-1], g.shape[0],
+                          g.lat.values[-1], g.lon.values[-1], _samples(g),
                           departure, stop.arrival, prev_place, stop.place,
                           _move_length(g, distf)])
         departure = stop.departure
@@ -373,7 +1645,7 @@ def get_moves(df, stops, min_duration, min_dist, distf):
         g = df[df.datetime >= departure]
         if not g.empty:
             moves.append([g.lat.values[0], g.lon.values[0],
-                          g.lat.values[-1], g.lon.values[-1], g.shape[0],
+                          g.lat.values[-1], g.lon.values[-1], _samples(g),
                           departure, g.datetime.max(), prev_place, np.nan,
                           _move_length(g, distf)])
     moves = pd.DataFrame(moves, columns=['from_lat', 'from_lon', 'to_lat', 'to_lon',
@@ -387,6 +1659,11 @@ def get_moves(df, stops, min_duration, min_dist, distf):
     return moves
 
 
+def _samples(g):
+    """Number of location samples in a group of points, using weights of simplified points."""
+    return int(g.weight.sum()) if 'weight' in g.columns else g.shape[0]
+
+
 def _move_length(move, distf):
     """
     Compute length of a move as the sum of distance between points.
@@ -397,31 +1674,292 @@ def _move_length(move, distf):
     """
     if len(move) <= 1:
         return 0
-    g = move.copy()
-    g['lat1'] = g.lat.shift().bfill()
-    g['lon1'] = g.lon.shift().bfill()
-    return g.apply(lambda r: distf((r.lat, r.lon), (r.lat1, r.lon1)), axis=1).sum()
+    lat, lon = move.lat.values.astype(float), move.lon.values.astype(float)
+    return _distances(distf, lat[1:], lon[1:], lat[:-1], lon[:-1]).sum()
+
+
+# place index
+
+METERS_PER_DEGREE = 111320.0
+
+
+class PlaceIndex:
+    """
+    Grid index over places for nearest place queries.
+
+    Places are put in cells of a latitude/longitude grid with cells of about
+    cell_size meters. A query only computes distances to places in the cells
+    around each point, so the cost of a query does not grow with the number of
+    places. Queries take arrays of points and are vectorized.
+
+    :param places: dataframe of places with columns: place, latitude, longitude,
+                   e.g. as returned by get_stops_places_and_moves.
+    :param cell_size: cell size in meters, queries within this radius probe 3x3 cells.
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters)
+    """
+
+    def __init__(self, places, cell_size=50, distf=haversine_distance):
+        assert cell_size > 0
+        places = places.rename(columns={'lat': 'latitude', 'lon': 'longitude'})
+        self.cell_size = cell_size
+        self.distf = distf
+        self.labels = places.place.values
+        self.lat = places.latitude.values.astype(float)
+        self.lon = places.longitude.values.astype(float)
+        self._lat_step = cell_size / METERS_PER_DEGREE
+        # longitude cells are sized for the latitude where a degree is shortest,
+        # so no place within cell_size is more than one cell away
+        max_lat = np.abs(self.lat).max() + self._lat_step if len(self.lat) else 0.0
+        self._lon_step = self._lat_step / np.cos(np.radians(min(max_lat, 89.0)))
+        keys = self._keys(*self._cells(self.lat, self.lon))
+        self._order = np.argsort(keys, kind='mergesort')
+        self._keys_sorted = keys[self._order]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def query(self, lat, lon, radius=None):
+        """
+        Find the nearest place within a radius of each point.
+
+        :param lat: array of latitudes.
+        :param lon: array of longitudes.
+        :param radius: maximum distance in meters, defaults to cell_size.
+        :return: array of place labels, -1 where no place is within radius,
+                 and array of distances in meters, nan where no place is within radius.
+        """
+        lat = np.atleast_1d(np.asarray(lat, dtype=float))
+        lon = np.atleast_1d(np.asarray(lon, dtype=float))
+        radius = self.cell_size if radius is None else radius
+        labels = np.full(len(lat), -1, dtype=self.labels.dtype if len(self.labels) else int)
+        distances = np.full(len(lat), np.nan)
+        if not len(self.labels) or not len(lat):
+            return labels, distances
+        # pairs of (point, candidate place) of places in the cells around each point
+        rows, cols = self._cells(lat, lon)
+        k = int(np.ceil(radius / self.cell_size))
+        pairs = [self._candidates(self._keys(rows + dr, cols + dc))
+                 for dr in range(-k, k + 1) for dc in range(-k, k + 1)]
+        q = np.concatenate([p[0] for p in pairs])
+        c = np.concatenate([p[1] for p in pairs])
+        d = _distances(self.distf, lat[q], lon[q], self.lat[c], self.lon[c])
+        inside = d <= radius
+        q, c, d = q[inside], c[inside], d[inside]
+        # keep the closest place of each point
+        order = np.lexsort((d, q))
+        q, c, d = q[order], c[order], d[order]
+        first = np.r_[True, q[1:] != q[:-1]] if len(q) else np.zeros(0, dtype=bool)
+        labels[q[first]] = self.labels[c[first]]
+        distances[q[first]] = d[first]
+        return labels, distances
+
+    def label(self, df, radius=None):
+        """
+        Label location points or stops with the nearest place within a radius.
+
+        :param df: dataframe with columns latitude and longitude, or lat and lon.
+        :param radius: maximum distance in meters, defaults to cell_size.
+        :return: series of place labels with the index of df, -1 where no place is within radius.
+        """
+        lat = df.latitude.values if 'latitude' in df.columns else df.lat.values
+        lon = df.longitude.values if 'longitude' in df.columns else df.lon.values
+        return pd.Series(self.query(lat, lon, radius)[0], index=df.index, name='place')
+
+    def _cells(self, lat, lon):
+        return (np.floor(lat / self._lat_step).astype(np.int64),
+                np.floor(lon / self._lon_step).astype(np.int64))
+
+    @staticmethod
+    def _keys(rows, cols):
+        # unique for cells down to about a meter, cols are shifted to be non-negative
+        return rows * (1 << 32) + (cols + (1 << 31))
+
+    def _candidates(self, keys):
+        """Pairs of (query index, place index) of places in the cell of each query key."""
+        lo = np.searchsorted(self._keys_sorted, keys, 'left')
+        hi = np.searchsorted(self._keys_sorted, keys, 'right')
+        counts = hi - lo
+        q = np.repeat(np.arange(len(keys)), counts)
+        # position of each candidate within its cell
+        within = np.arange(len(q)) - np.repeat(np.cumsum(counts) - counts, counts)
+        return q, self._order[np.repeat(lo, counts) + within]
+
+
+def label_points(df, places, dist=25, distf=haversine_distance):
+    """
+    Label location points with the nearest place within a distance.
+
+    All points are labelled in one vectorized query of a PlaceIndex.
+
+    :param df: dataframe of location points with columns: latitude and longitude.
+    :param places: dataframe of places with columns: place, latitude, longitude.
+    :param dist: maximum distance from a point to its place in meters.
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters)
+    :return: copy of df with a place column, -1 for points not at any place.
+    """
+    df = df.copy()
+    df['place'] = PlaceIndex(places, dist, distf).label(df).values
+    return df
 
 
 # time spent at places
 
+def get_time_at_places_daily(df, max_gap=10):
+    """
+    Compute time spent at places per day from labelled location points.
+
+    Each point accounts for the time until the next point of the same day,
+    at most max_gap minutes, so gaps in the data are not counted.
+
+    :param df: dataframe of location points with columns: user_id, date, datetime, place,
+               e.g. as returned by label_points.
+    :param max_gap: maximum time in minutes accounted to one point.
+    :return: dataframe with columns user_id, date, place, duration in minutes and samples.
+    """
+    df = df.sort_values(['user_id', 'datetime'], kind='mergesort')
+    next_datetime = df.groupby(['user_id', 'date'])['datetime'].shift(-1)
+    minutes = (next_datetime - df['datetime']).dt.total_seconds().fillna(0) / 60
+    df = df.assign(duration=minutes.clip(upper=max_gap),
+                   samples=df['weight'] if 'weight' in df.columns else 1)
+    return df.groupby(['user_id', 'date', 'place'], sort=True) \
+             .agg({'duration': 'sum', 'samples': 'sum'}).reset_index()
+
+
+class OccupancyCube:
+    """
+    Time spent at the places of one user by weekday and hour of the day.
+
+    The cube is computed once from the stops of a user and updated as new
+    stops arrive, so the time spent at any places on any weekdays is a sum
+    over a slice of the cube instead of a pass over all stops. Time is kept
+    in two units:
+
+    - 'minutes': minutes of stops in each hour.
+    - 'samples': hourly samples of stops from their arrival to their departure,
+      as counted by get_time_spent_at_place_hours_of_day and routine_index.
+
+    :param stops: optional dataframe of labeled stops with columns: arrival, departure, place.
+    """
+
+    UNITS = ['minutes', 'samples']
+
+    def __init__(self, stops=None):
+        # place label of each column of the cube
+        self.places = []
+        # time in each unit of shape (weekday 0-6, hour 0-23, place)
+        self.minutes = np.zeros((7, 24, 0))
+        self.samples = np.zeros((7, 24, 0), dtype=np.int64)
+        self._columns = {}
+        if stops is not None:
+            self.add(stops)
+
+    def add(self, stops):
+        """
+        Add the time of stops to the cube.
+
+        Stops are split into the hours they overlap, so stops spanning midnight
+        count on both weekdays.
+
+        :param stops: dataframe of labeled stops with columns: arrival, departure, place.
+        :return: self.
+        """
+        labels = stops.place.values
+        for p in pd.unique(labels):
+            if p not in self._columns:
+                self._columns[p] = len(self.places)
+                self.places.append(p)
+        new = len(self.places) - self.minutes.shape[2]
+        if new:
+            self.minutes = np.concatenate([self.minutes, np.zeros((7, 24, new))], axis=2)
+            self.samples = np.concatenate(
+                [self.samples, np.zeros((7, 24, new), dtype=np.int64)], axis=2)
+        columns = np.array([self._columns[p] for p in labels], dtype=np.int64)
+        arrival = stops.arrival.values.astype('datetime64[s]').astype(np.int64)
+        departure = stops.departure.values.astype('datetime64[s]').astype(np.int64)
+        # one slot for every hour overlapped by a stop
+        first = arrival // 3600 * 3600
+        slots = np.maximum((departure - first) // 3600 + 1, 0)
+        start = np.repeat(first, slots) \
+            + 3600 * (np.arange(slots.sum()) - np.repeat(np.cumsum(slots) - slots, slots))
+        minutes = (np.minimum(np.repeat(departure, slots), start + 3600)
+                   - np.maximum(np.repeat(arrival, slots), start)) / 60.0
+        # 1970-01-01 was a Thursday, weekday 3
+        weekday = (start // 86400 + 3) % 7
+        hour = start % 86400 // 3600
+        np.add.at(self.minutes, (weekday, hour, np.repeat(columns, slots)), minutes)
+        # hourly samples
+        time, hour, _ = _hourly_samples(stops)
+        weekday = (time // (24 * NS_PER_HOUR) + 3) % 7
+        np.add.at(self.samples, (weekday, hour, np.repeat(columns, _hourly_sample_counts(stops))),
+                  1)
+        return self
+
+    def time_spent(self, place_labels=None, days=range(7), unit='minutes'):
+        """
+        Time spent at places for each hour of the day.
+
+        :param place_labels: list of place labels, all places by default.
+        :param days: list of weekdays (0-6) to sum.
+        :param unit: unit of time, one of UNITS.
+        :return: dataframe with labels as columns and a row for each hour of the day (0-23).
+        """
+        if unit not in self.UNITS:
+            raise ValueError('unknown unit: %s' % unit)
+        cube = self.minutes if unit == 'minutes' else self.samples
+        place_labels = list(place_labels) if place_labels is not None else list(self.places)
+        time = cube[list(days)].sum(axis=0)
+        values = np.zeros((24, len(place_labels)), dtype=cube.dtype)
+        for i, p in enumerate(place_labels):
+            if p in self._columns:
+                values[:, i] = time[:, self._columns[p]]
+        return pd.DataFrame(values, index=range(24), columns=place_labels)
+
+    def hours_of_day(self, place_labels=None, days=range(7), unit='minutes'):
+        """
+        Proportion of time spent at places for each hour of the day.
+
+        :param place_labels: list of place labels, all places by default.
+        :param days: list of weekdays (0-6) to consider.
+        :param unit: unit of time, one of UNITS.
+        :return: dataframe with labels as columns and a row for each hour of the day (0-23).
+        """
+        hours = self.time_spent(place_labels, days, unit)
+        return hours.div(hours.sum(axis=1), axis=0)  # normalize
+
+
 def get_time_spent_at_place_hours_of_day(stops, place_labels=None, days=range(7)):
     """
     Compute proportion of time spent at specified places for each hour of the day.
 
+    Time is counted in hourly samples of stops starting at their arrival. For
+    repeated queries on the same stops, create an OccupancyCube once and use
+    its hours_of_day with unit='samples', or unit='minutes' for the minutes of
+    stops in each hour.
+
     :param place_labels: list of place labels to consider.
     :param stops: dataframe of labeled stops.
     :param days: list of weekdays (0-6) to consider in the analysis.
     :return: dataframe with labels as columns and a row for each hour of the day (0-23).
     """
-    place_labels = place_labels if place_labels is not None else stops.place.unique()
-    hours = pd.DataFrame(0, index=range(24), columns=list(place_labels))
-    for p in place_labels:
-        for index, stop in stops[stops.place == p].iterrows():
-            h = pd.date_range(stop.arrival, stop.departure, freq='H')
-            hours[p] += np.histogram(h[h.dayofweek.isin(days)].hour, bins=np.arange(25))[0]
-    hours = hours.div(hours.sum(axis=1), axis=0)  # normalize
-    return hours
+    return OccupancyCube(stops).hours_of_day(place_labels, days, unit='samples')
+
+
+def get_hour_slots(stops):
+    """
+    Compute minutes of each stop spent in each hour of its day.
+
+    The vectorized counterpart of the hour slots of stops in the mobility
+    features package, summing the slots of a day by place gives its hour matrix.
+
+    :param stops: dataframe of stops with columns: arrival and departure, and date if available.
+    :return: array of shape (number of stops, 24) with minutes in each hour.
+    """
+    arrival = stops.arrival.values.astype('datetime64[s]').astype(np.int64)
+    departure = stops.departure.values.astype('datetime64[s]').astype(np.int64)
+    days = stops.date.values if 'date' in stops.columns else stops.arrival.dt.normalize().values
+    start = days.astype('datetime64[s]').astype(np.int64)[:, None] + np.arange(24) * 3600
+    overlap = np.minimum(departure[:, None], start + 3600) - np.maximum(arrival[:, None], start)
+    return np.clip(overlap, 0, None) / 60.0
 
 
 def add_time_spent_column(places, hours, start, end):
@@ -435,14 +1973,9 @@ def add_time_spent_column(places, hours, start, end):
     :return: dataframe of places with time spent column.
     """
     column = 't_%dto%d' % (start, end)
-    places[column] = np.nan
-    for label in hours.columns:
-        if start < end:
-            time = hours[label][start:end].sum() / float(end - start)
-        else:
-            time = (hours[label][start:].sum() + hours[label][:end].sum()) \
-                / float(24 - start + end)
-        places.loc[places.place == label, column] = time
+    interval = np.arange(start, end) if start < end else np.r_[start:24, 0:end]
+    time = hours.iloc[interval].sum() / float(len(interval))
+    places[column] = places.place.map(time).astype(float)
     return places
 
 
@@ -508,7 +2041,7 @@ def routine_index_difference(day1, day2):
 
 # additional location features
 
-def radius_of_gyration(stops, distf=lambda a, b: geodesic(a, b).meters):
+def radius_of_gyration(stops, distf=geodesic_distance):
     """
     Compute radius of gyration feature from stops.
 
@@ -520,12 +2053,12 @@ def radius_of_gyration(stops, distf=lambda a, b: geodesic(a, b).meters):
     """
     if stops.empty:
         return 0.0
-    centroid = (stops.latitude.mean(), stops.longitude.mean())
-    d = stops.apply(lambda r: distf((r.latitude, r.longitude), centroid), axis=1)
-    return np.sqrt((stops.duration * d**2).sum() / stops.duration.sum())
+    d = _distances(distf, stops.latitude.values.astype(float), stops.longitude.values.astype(float),
+                   stops.latitude.mean(), stops.longitude.mean())
+    return np.sqrt((stops.duration.values * d**2).sum() / stops.duration.sum())
 
 
-def std_of_displacements(stops, distf=lambda a, b: geodesic(a, b).meters):
+def std_of_displacements(stops, distf=geodesic_distance):
     """
     Compute standard deviation of displacements feature from stops.
 
@@ -537,10 +2070,8 @@ def std_of_displacements(stops, distf=lambda a, b: geodesic(a, b).meters):
     """
     if len(stops) < 2:
         return 0.0
-    dis = [distf((stops.iloc[i].latitude, stops.iloc[i].longitude),
-                 (stops.iloc[i + 1].latitude, stops.iloc[i + 1].longitude))
-           for i in range(len(stops) - 1)]
-    return np.std(dis)
+    lat, lon = stops.latitude.values.astype(float), stops.longitude.values.astype(float)
+    return np.std(_distances(distf, lat[:-1], lon[:-1], lat[1:], lon[1:]))
 
 
 def log_variance(locations):
@@ -568,3 +2099,512 @@ def entropy(stops):
         return 0.0
     ps = stops.groupby(stops.place).sum().duration / stops.duration.sum()
     return -ps.map(lambda p: p * np.log(p)).sum()
+
+
+def home_stay(stops, places=None, start_hour=0, end_hour=6):
+    """
+    Compute home stay per user per day from stops.
+
+    The home of a day is the place where most time is spent between start_hour
+    and end_hour. Home stay is the time spent at home divided by the time from
+    midnight to the departure of the last stop of the day, as in the mobility
+    features package. All users and days are computed in one pass.
+
+    :param stops: dataframe of labeled stops with columns: user_id, date, place,
+                  arrival, departure and duration in minutes.
+    :param places: optional dataframe of places, adds the coordinates of the home to the result.
+    :param start_hour: first hour of the night (0-23).
+    :param end_hour: hour after the last hour of the night (1-24).
+    :return: dataframe with columns user_id, date, home and home_stay, where home and
+             home_stay are -1 on days without stops at night.
+    """
+    columns = ['user_id', 'date', 'home', 'home_stay']
+    if stops.empty:
+        return pd.DataFrame(columns=columns)
+    keys = ['user_id', 'date']
+    night = get_hour_slots(stops)[:, start_hour:end_hour].sum(axis=1)
+    stops = stops[keys + ['place', 'departure', 'duration']].assign(night=night)
+    # time at each place per day, the home is the place with most time at night
+    at_place = stops.groupby(keys + ['place'], sort=False) \
+                    .agg({'night': 'sum', 'duration': 'sum'}).reset_index()
+    at_place = at_place.sort_values(keys + ['night', 'place'], ascending=[True, True, False, True],
+                                    kind='mergesort')
+    res = at_place.drop_duplicates(keys).rename(columns={'place': 'home'})
+    res = res.merge(stops.groupby(keys, sort=False).departure.max().reset_index(), on=keys)
+    elapsed = (res.departure - pd.to_datetime(res.date)).dt.total_seconds() / 60
+    res['home_stay'] = res.duration / elapsed
+    res.loc[res.night <= 0, ['home', 'home_stay']] = -1
+    res = res[columns].reset_index(drop=True)
+    if places is not None:
+        places = places.rename(columns={'lat': 'latitude', 'lon': 'longitude'})
+        res = res.merge(places[['user_id', 'place', 'latitude', 'longitude']]
+                        .rename(columns={'place': 'home'}), on=['user_id', 'home'], how='left')
+    return res
+
+
+def get_daily_features(df, stops, moves, distf=geodesic_distance):
+    """
+    Compute location features per user per day.
+
+    :param df: dataframe of preprocessed location points with columns:
+               user_id, date, latitude, longitude.
+    :param stops: dataframe of labeled stops as returned by get_stops_places_and_moves_daily.
+    :param moves: dataframe of moves as returned by get_stops_places_and_moves_daily.
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters),
+                  or 'local' for a local projection of the points.
+    :return: dataframe with a row for each user and day.
+    """
+    distf = _resolve_distance(distf, df)
+    return _add_move_features(_stop_features(df, stops, distf), moves)
+
+
+def _stop_features(df, stops, distf):
+    """
+    Compute the daily features that do not depend on moves.
+
+    number_of_moves and distance are 0, _add_move_features sets them from moves.
+    """
+    columns = ['user_id', 'date', 'number_of_stops', 'number_of_places', 'number_of_moves',
+               'distance', 'radius_of_gyration', 'std_of_displacements', 'log_variance',
+               'entropy', 'routine_index', 'home_stay']
+    rows = []
+    for (user_id, date), points in df.groupby(['user_id', 'date']):
+        s = stops[(stops.user_id == user_id) & (stops.date == date)]
+        rows.append([user_id, date, len(s), s.place.nunique(), 0, 0.0,
+                     radius_of_gyration(s, distf), std_of_displacements(s, distf),
+                     log_variance(points), entropy(s)])
+    features = pd.DataFrame(rows, columns=columns[:-2])
+    if stops.empty:
+        features['routine_index'] = np.nan
+        features['home_stay'] = -1.0
+    else:
+        features = features.merge(get_routine_indices(stops), on=['user_id', 'date'], how='left')
+        features = features.merge(home_stay(stops)[['user_id', 'date', 'home_stay']],
+                                  on=['user_id', 'date'], how='left')
+        features['home_stay'] = features['home_stay'].fillna(-1.0)
+    return features[columns]
+
+
+def _add_move_features(features, moves):
+    """Set number_of_moves and distance of daily features from moves."""
+    features = features.copy()
+    days = pd.MultiIndex.from_frame(features[['user_id', 'date']])
+    m = moves.groupby(['user_id', 'date']).distance.agg(['size', 'sum']).reindex(days)
+    features['number_of_moves'] = m['size'].fillna(0).values.astype(np.int64)
+    features['distance'] = m['sum'].fillna(0.0).values.astype(float)
+    return features
+
+
+# features as of times of the day
+
+NS_PER_MINUTE = 60 * 10**9
+NS_PER_HOUR = 3600 * 10**9
+
+
+def get_daily_features_as_of(df, stops, moves, times, distf=geodesic_distance):
+    """
+    Compute location features per user per day as of times of the day.
+
+    The features as of a time are those of get_daily_features for the location
+    points until that time, the stops that arrived until then with the stop in
+    progress ending at that time, and the moves that ended until then. Stops are
+    not detected again, so a stop in progress counts from its arrival.
+    routine_index compares the day until a time to the other days of stops, as
+    get_daily_features does.
+
+    Prefix aggregates over the points, stops and moves of a day are computed
+    once, and the features of all times of the day are computed from them
+    together.
+
+    :param df: dataframe of preprocessed location points with columns:
+               user_id, date, datetime, latitude, longitude.
+    :param stops: dataframe of labeled stops as returned by get_stops_places_and_moves_daily.
+    :param moves: dataframe of moves as returned by get_stops_places_and_moves_daily.
+    :param times: datetimes to compute the features at, each for the day it falls on.
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters),
+                  or 'local' for a local projection of the points.
+    :return: dataframe with a row for each user and time with the columns of
+             get_daily_features and the time after date.
+    """
+    columns = ['user_id', 'date', 'time', 'number_of_stops', 'number_of_places',
+               'number_of_moves', 'distance', 'radius_of_gyration', 'std_of_displacements',
+               'log_variance', 'entropy', 'routine_index', 'home_stay']
+    distf = _resolve_distance(distf, df)
+    times = pd.DatetimeIndex(pd.to_datetime(times)).sort_values()
+    dates = times.normalize()
+    frames = []
+    for (user_id, date), points in df.groupby(['user_id', 'date']):
+        t = times[dates == pd.Timestamp(date)]
+        if len(t) == 0:
+            continue
+        user_stops = stops[stops.user_id == user_id]
+        day = user_stops.date == date
+        res = pd.DataFrame(_features_as_of(
+            points.sort_values('datetime', kind='mergesort'),
+            user_stops[day].sort_values('arrival', kind='mergesort'),
+            moves[(moves.user_id == user_id) & (moves.date == date)],
+            user_stops[~day], pd.Timestamp(date), t.values, distf))
+        res.insert(0, 'user_id', user_id)
+        res.insert(1, 'date', date)
+        res.insert(2, 'time', t)
+        frames.append(res)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+def _features_as_of(points, stops, moves, history, midnight, times, distf,
+                    start_hour=0, end_hour=6):
+    """
+    Compute the features of one user-day as of times of the day.
+
+    :param points: location points of the day sorted chronologically.
+    :param stops: labeled stops of the day sorted chronologically.
+    :param moves: moves of the day.
+    :param history: labeled stops of the other days of the user.
+    :param midnight: start of the day.
+    :param times: array of datetime64[ns] within the day.
+    :return: dict of feature --> array with a value for each time.
+    """
+    t = times.astype('datetime64[ns]').astype(np.int64)
+    res = {}
+
+    # stops until each time, the last one ends at the time
+    arrival = stops.arrival.values.astype('datetime64[ns]').astype(np.int64)
+    departure = stops.departure.values.astype('datetime64[ns]').astype(np.int64)
+    k = np.searchsorted(arrival, t, side='right')
+    last = np.maximum(k - 1, 0)
+    started = k > 0
+    end = np.minimum(departure[last], t) if len(stops) else t
+    clipped = np.where(started, (end - arrival[last]) / NS_PER_MINUTE, 0.0) \
+        if len(stops) else np.zeros(len(t))
+    res['number_of_stops'] = k
+
+    # cumulative time, nights and stops per place before the last stop
+    labels, place = np.unique(stops.place.values, return_inverse=True)
+    duration = stops.duration.values.astype(float)
+    night = get_hour_slots(stops)[:, start_hour:end_hour].sum(axis=1)
+    one_hot = np.zeros((len(stops), len(labels)))
+    one_hot[np.arange(len(stops)), place] = 1
+    cumulative = [np.vstack([np.zeros((1, len(labels))), np.cumsum(one_hot * v[:, None], axis=0)])
+                  for v in (duration, night, np.ones(len(stops)))]
+    at_place, night_at_place, stops_at_place = [c[last].copy() for c in cumulative]
+    rows = np.flatnonzero(started)
+    if len(rows):
+        night_start = midnight.value + start_hour * NS_PER_HOUR
+        night_end = midnight.value + end_hour * NS_PER_HOUR
+        last_night = np.clip(np.minimum(end, night_end) - np.maximum(arrival[last], night_start),
+                             0, None) / NS_PER_MINUTE
+        columns = place[last[rows]]
+        at_place[rows, columns] += clipped[rows]
+        night_at_place[rows, columns] += last_night[rows]
+        stops_at_place[rows, columns] += 1
+    res['number_of_places'] = (stops_at_place > 0).sum(axis=1)
+
+    # moves that ended until each time
+    order = np.argsort(moves.arrival.values, kind='mergesort')
+    move_arrival = moves.arrival.values[order].astype('datetime64[ns]').astype(np.int64)
+    n_moves = np.searchsorted(move_arrival, t, side='right')
+    res['number_of_moves'] = n_moves
+    res['distance'] = np.r_[0.0, np.cumsum(moves.distance.values[order].astype(float))][n_moves]
+
+    # radius of gyration around the centroid of the stops until each time
+    lat, lon = stops.latitude.values.astype(float), stops.longitude.values.astype(float)
+    squared = np.zeros((len(stops) + 1, len(stops)))
+    for n in np.unique(k[started]):
+        squared[n, :n] = _distances(distf, lat[:n], lon[:n], lat[:n].mean(), lon[:n].mean())**2
+    i = np.arange(len(stops))
+    weights = np.where(i < last[:, None], duration,
+                       np.where(i == last[:, None], clipped[:, None], 0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rog = np.sqrt((weights * squared[k]).sum(axis=1) / weights.sum(axis=1))
+    res['radius_of_gyration'] = np.where(started, rog, 0.0)
+
+    # running variance of displacements between stops
+    displacements = _distances(distf, lat[:-1], lon[:-1], lat[1:], lon[1:]) \
+        if len(stops) > 1 else np.zeros(0)
+    displacements = displacements - displacements[:1].sum()  # centered for precision
+    sums = np.r_[0.0, np.cumsum(displacements)]
+    squares = np.r_[0.0, np.cumsum(displacements**2)]
+    m = np.maximum(k - 1, 1)
+    variance = np.clip(squares[k - started] / m - (sums[k - started] / m)**2, 0, None)
+    res['std_of_displacements'] = np.where(k >= 2, np.sqrt(variance), 0.0)
+
+    # running variance of coordinates of the points until each time
+    n = np.searchsorted(points.datetime.values, times, side='right')
+    variances = []
+    for c in ('latitude', 'longitude'):
+        x = points[c].values.astype(float)
+        x = x - x[0] if len(x) else x  # centered for precision
+        s1, s2 = np.r_[0.0, np.cumsum(x)][n], np.r_[0.0, np.cumsum(x**2)][n]
+        variances.append((s2 - s1**2 / np.maximum(n, 1)) / np.maximum(n - 1, 1))
+    res['log_variance'] = np.where(n >= 2, np.log(np.clip(variances[0] + variances[1], 0, None)
+                                                  + 1), 0.0)
+
+    # entropy of time at places
+    total = at_place.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        p = at_place / total
+        res['entropy'] = np.where(p > 0, -p * np.log(np.where(p > 0, p, 1)), 0.0).sum(axis=1)
+
+    res['routine_index'] = _routine_index_as_of(stops, history, t, started)
+
+    # home is the place with most time at night, ties go to the smallest label
+    home = night_at_place.argmax(axis=1) if len(labels) else np.zeros(len(t), dtype=int)
+    has_home = started & (night_at_place.max(axis=1, initial=0) > 0)
+    elapsed = (end - midnight.value) / NS_PER_MINUTE
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stay = at_place[np.arange(len(t)), home] / elapsed if len(labels) else np.zeros(len(t))
+    res['home_stay'] = np.where(has_home, stay, -1.0)
+    return res
+
+
+def _routine_index_as_of(stops, history, t, started):
+    """
+    Compute the routine index of a day as of times, see routine_index.
+
+    An hour of the day matches another day from the first hourly sample of a
+    stop at a place where the other day also has a stop in that hour.
+
+    :param stops: labeled stops of the day sorted chronologically.
+    :param history: labeled stops of the other days.
+    :param t: array of times in nanoseconds.
+    :param started: array with True for times after the arrival of the first stop.
+    :return: array with the routine index at each time, NaN before the first stop.
+    """
+    if history.empty:
+        return np.where(started, 0.0, np.nan)
+    time, hour, place = _hourly_samples(stops)
+    other_time, other_hour, other_place = _hourly_samples(history)
+    days, day = np.unique(history.date.values, return_inverse=True)
+    day = np.repeat(day, _hourly_sample_counts(history))
+    labels = np.unique(np.r_[place, other_place])
+    place, other_place = np.searchsorted(labels, place), np.searchsorted(labels, other_place)
+    # hours of each place on the other days
+    hours = np.zeros((len(days), len(labels), 24), dtype=bool)
+    hours[day, other_place, other_hour] = True
+    # first time each hour matches each other day
+    first = np.full((len(days), 24), np.iinfo(np.int64).max)
+    d, i = np.nonzero(hours[:, place, hour])
+    np.minimum.at(first, (d, hour[i]), time[i])
+    difference = 1 - (first[None, :, :] <= t[:, None, None]).mean(axis=2)
+    return np.where(started, difference.mean(axis=1), np.nan)
+
+
+def _hourly_sample_counts(stops):
+    """Number of hourly samples from arrival to departure of each stop."""
+    arrival = stops.arrival.values.astype('datetime64[ns]').astype(np.int64)
+    departure = stops.departure.values.astype('datetime64[ns]').astype(np.int64)
+    return (departure - arrival) // NS_PER_HOUR + 1
+
+
+def _hourly_samples(stops):
+    """
+    Hourly samples of stops from arrival to departure as in routine_index_difference.
+
+    :return: arrays of time in nanoseconds, hour of the day and place of each sample.
+    """
+    counts = _hourly_sample_counts(stops)
+    arrival = stops.arrival.values.astype('datetime64[ns]').astype(np.int64)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    time = np.repeat(arrival, counts) + offsets * NS_PER_HOUR
+    return time, time // NS_PER_HOUR % 24, np.repeat(stops.place.values, counts)
+
+
+# rolling window features
+
+class WindowStatistics:
+    """
+    Sufficient statistics of the stops and location points of the days in a window.
+
+    Days enter the window with add and leave it with subtract, and the features
+    of the stops and points of all days in the window are computed from the
+    sums, so sliding a window over days costs one update per day entering and
+    leaving instead of recomputing the features over every window.
+
+    :param n_places: number of places of the user.
+    """
+
+    def __init__(self, n_places):
+        self.time_at_place = np.zeros(n_places)
+        self.stops_at_place = np.zeros(n_places, dtype=np.int64)
+        # stops, sum of x, y and of duration, duration * x, duration * y, duration * (x^2 + y^2)
+        self.stop_moments = np.zeros(7)
+        # points, sum of latitude, latitude^2, longitude and longitude^2
+        self.point_moments = np.zeros(5)
+        # for each hour of the day, bit mask of the places of a day --> days in the window
+        self.hour_places = [Counter() for _ in range(24)]
+        self.days_with_stops = 0
+
+    def add(self, day, sign=1):
+        """
+        Add the statistics of a day to the window.
+
+        :param day: _DayStatistics of the day.
+        :param sign: 1 to add the day, -1 to subtract it.
+        """
+        self.time_at_place += sign * day.time_at_place
+        self.stops_at_place += sign * day.stops_at_place
+        self.stop_moments += sign * day.stop_moments
+        self.point_moments += sign * day.point_moments
+        if day.stop_moments[0] > 0:
+            self.days_with_stops += sign
+            for counts, mask in zip(self.hour_places, day.hour_masks):
+                counts[mask] += sign
+                if counts[mask] == 0:
+                    del counts[mask]
+
+    def subtract(self, day):
+        """Subtract the statistics of a day leaving the window."""
+        self.add(day, -1)
+
+    def number_of_places(self):
+        """Number of places with stops in the window."""
+        return int((self.stops_at_place > 0).sum())
+
+    def entropy(self):
+        """Entropy of time spent at places, see entropy."""
+        if self.stop_moments[0] <= 0:
+            return 0.0
+        p = self.time_at_place[self.time_at_place > 0] / self.time_at_place.sum()
+        return float(-(p * np.log(p)).sum())
+
+    def radius_of_gyration(self):
+        """Radius of gyration of stops with distances in the projection of the coordinates."""
+        n, x, y, w, wx, wy, wxy = self.stop_moments
+        if n <= 0:
+            return 0.0
+        cx, cy = x / n, y / n  # centroid of the stops
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return float(np.sqrt(max(wxy - 2 * (cx * wx + cy * wy) + (cx**2 + cy**2) * w, 0) / w))
+
+    def log_variance(self):
+        """Logarithm of combined variance of latitude and longitude of points, see log_variance."""
+        n, lat, lat2, lon, lon2 = self.point_moments
+        if n < 2:
+            return 0.0
+        variance = (lat2 - lat**2 / n + lon2 - lon**2 / n) / (n - 1)
+        return float(np.log(max(variance, 0) + 1))
+
+    def routine_index(self, day):
+        """
+        Routine index of a day in the window compared to the other days of the window.
+
+        :param day: _DayStatistics of a day added to the window.
+        :return: routine index, see routine_index, or NaN if the day has no stops.
+        """
+        if day.stop_moments[0] <= 0:
+            return np.nan
+        others = self.days_with_stops - 1
+        if others == 0:
+            return 0.0
+        # days matching each hour, without the day itself
+        matches = sum(sum(n for m, n in counts.items() if m & mask) - 1
+                      for counts, mask in zip(self.hour_places, day.hour_masks) if mask)
+        return 1 - matches / (24.0 * others)
+
+
+_DayStatistics = namedtuple('_DayStatistics', ['time_at_place', 'stops_at_place', 'stop_moments',
+                                               'point_moments', 'hour_masks'])
+
+
+def get_rolling_features(df, stops, windows=(7, 28)):
+    """
+    Compute location features per user per day over windows of days.
+
+    The features of a window are those of the stops and points of the days in
+    the window computed together: number of places, entropy, radius of gyration
+    and log variance, and the routine index of the day compared to the other days
+    of the window. A window of n days ends at the day and contains the days
+    from n - 1 days before, with or without data.
+
+    Statistics of each day are computed once and windows slide over the days
+    of a user with WindowStatistics. The radius of gyration uses Euclidean
+    distances in a local projection of the stops of the user, see
+    LocalProjection for its error compared to haversine distances.
+
+    :param df: dataframe of preprocessed location points with columns:
+               user_id, date, latitude, longitude.
+    :param stops: dataframe of labeled stops as returned by get_stops_places_and_moves_daily.
+    :param windows: numbers of days of the windows.
+    :return: dataframe with a row for each user and day with points or stops, with columns
+             user_id, date
+             and number_of_places, entropy, radius_of_gyration, log_variance and
+             routine_index for each window with suffix _<n>d.
+    """
+    features = ['number_of_places', 'entropy', 'radius_of_gyration', 'log_variance',
+                'routine_index']
+    columns = ['user_id', 'date'] + ['%s_%dd' % (f, n) for n in windows for f in features]
+    frames = []
+    for user_id, points in df.groupby('user_id'):
+        dates, days = _day_statistics(points, stops[stops.user_id == user_id])
+        res = pd.DataFrame({'user_id': user_id, 'date': dates})
+        for n in windows:
+            window = WindowStatistics(len(days[0].time_at_place))
+            first = 0
+            rows = []
+            for i, day in enumerate(days):
+                window.add(day)
+                while dates[first] <= dates[i] - pd.Timedelta(days=n):
+                    window.subtract(days[first])
+                    first += 1
+                rows.append([window.number_of_places(), window.entropy(),
+                             window.radius_of_gyration(), window.log_variance(),
+                             window.routine_index(day)])
+            res[['%s_%dd' % (f, n) for f in features]] = pd.DataFrame(rows, index=res.index)
+        frames.append(res)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+def _day_statistics(points, stops):
+    """
+    Compute the statistics of each day of one user.
+
+    :param points: location points of the user.
+    :param stops: labeled stops of the user.
+    :return: dates with points or stops and list of _DayStatistics of each date.
+    """
+    # days of points and stops, so every stop counts on its own day
+    dates = pd.DatetimeIndex(pd.to_datetime(np.r_[points.date.values, stops.date.values])) \
+              .unique().sort_values()
+    n_days = len(dates)
+    # points, centered for precision
+    day = dates.get_indexer(pd.to_datetime(points.date.values))
+    lat = points.latitude.values.astype(float)
+    lon = points.longitude.values.astype(float)
+    lat, lon = lat - lat[0], lon - lon[0]
+    point_moments = np.column_stack([np.bincount(day, v, minlength=n_days)
+                                     for v in (None, lat, lat**2, lon, lon**2)])
+    # stops
+    labels, place = np.unique(stops.place.values, return_inverse=True)
+    day = dates.get_indexer(pd.to_datetime(stops.date.values))
+    assert (day >= 0).all()
+    duration = stops.duration.values.astype(float)
+    time_at_place = np.zeros((n_days, len(labels)))
+    np.add.at(time_at_place, (day, place), duration)
+    stops_at_place = np.zeros((n_days, len(labels)), dtype=np.int64)
+    np.add.at(stops_at_place, (day, place), 1)
+    projection = local_projection(stops, max_extent=np.inf)
+    x, y = projection.project(stops.latitude.values, stops.longitude.values) \
+        if len(stops) else (np.zeros(0), np.zeros(0))
+    stop_moments = np.column_stack([np.bincount(day, v, minlength=n_days) for v in
+                                    (None, x, y, duration, duration * x, duration * y,
+                                     duration * (x**2 + y**2))])
+    # places of the hourly samples of stops as bit masks per hour, see routine_index_difference
+    hour_masks = np.zeros((n_days, 24), dtype=object)
+    if len(stops):
+        counts = _hourly_sample_counts(stops)
+        _, hour, _ = _hourly_samples(stops)
+        for d, h, p in zip(np.repeat(day, counts), hour, np.repeat(place, counts)):
+            hour_masks[d, h] |= 1 << int(p)
+    return dates, [_DayStatistics(time_at_place[i], stops_at_place[i], stop_moments[i],
+                                  point_moments[i], tuple(hour_masks[i]))
+                   for i in range(n_days)]
+
+
+if __name__ == '__main__':
+    # python -m location runs the batch pipeline, see location_cli.py
+    from location_cli import main
+    main()
@@ -0,0 +1,161 @@
+"""
+Evaluation of daily location features against participant answers.
+
+Every day participants answer how many places they visited, how many hours
+they were away from home and how much the day followed their routine on a
+scale from 0 to 5. Features and answers of all users are joined in one merge
+on user_id and date, and the errors of the features are reduced per user and
+feature with groupby:
+
+    features, answers = read_study(ids, 'study_data')
+    evaluate(features, answers)
+
+Features can be the features files of the app or the results of
+get_daily_features and location_sweep.sweep. Home stay is the share of the
+time from midnight until the features were computed, so features need the
+datetime they were computed at. The app records it, for get_daily_features it
+is the departure of the last stop of the day, see feature_times, and sweep
+results include it:
+
+    features = get_daily_features(df, stops, moves).merge(feature_times(stops), how='left')
+    evaluate(features, answers)
+
+Grouping by the parameter columns of a sweep scores every parameter
+combination at once:
+
+    evaluate(sweep(df, grid), answers, by=location_sweep.PARAMS, per_user=False)
+
+The app computes a routine overlap, where 1 means the day followed the
+routine, and get_daily_features a routine index, where 0 means the day
+followed the routine. Features with a routine_index are compared as the
+overlap 1 - routine_index.
+
+Days are compared where the feature and answer are valid, as in
+study_analysis.ipynb:
+
+- places: days with places.
+- home_stay: days where home stay was computed, and the time away from home
+  is at most the time elapsed since midnight when the features were computed.
+- routine: days with places and a routine overlap, which needs earlier days.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+DIRECTORY = 'study_data'
+SECONDS_PER_HOUR = 3600
+
+# columns of the features files of the app --> columns of get_daily_features
+APP_COLUMNS = {
+    'number_of_places_today': 'number_of_places',
+    'home_stay_today': 'home_stay',
+    'routine_overlap_today': 'routine_overlap',
+}
+FEATURES = ['places', 'home_stay', 'routine']
+METRICS = ['n', 'mae', 'rmse', 'me', 'min', 'max']
+
+
+def read_study(user_ids, directory=DIRECTORY):
+    """
+    Read the features and answers files of users.
+
+    Files are named features_<user_id>.csv and answers_<user_id>.csv.
+
+    :param user_ids: list of user ids.
+    :param directory: directory of the files.
+    :return: dataframe of features and dataframe of answers of all users, with a user_id column.
+    """
+    features = _read_files(directory, 'features', user_ids).rename(columns=APP_COLUMNS)
+    answers = _read_files(directory, 'answers', user_ids)
+    return features, answers
+
+
+def _read_files(directory, name, user_ids):
+    """Read and combine the files of users, parsing datetime and date columns."""
+    df = pd.concat([pd.read_csv(os.path.join(directory, '%s_%s.csv' % (name, user_id)))
+                    .assign(user_id=user_id) for user_id in user_ids], ignore_index=True)
+    for c in ['datetime', 'date']:
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c])
+    return df
+
+
+def feature_times(stops):
+    """
+    Datetime of the home stay of get_daily_features for each day with stops.
+
+    :param stops: dataframe of stops as returned by get_stops_places_and_moves_daily.
+    :return: dataframe with columns user_id, date and datetime, the departure of
+             the last stop of the day.
+    """
+    return stops.groupby(['user_id', 'date']).departure.max().rename('datetime').reset_index()
+
+
+def errors(features, answers, by=()):
+    """
+    Join features and answers and compute the error of each valid feature and day.
+
+    :param features: dataframe of daily features with columns: user_id, date,
+                     number_of_places, home_stay, routine_overlap of the app or
+                     routine_index of get_daily_features, and the datetime the
+                     features were computed, see feature_times.
+    :param answers: dataframe of answers with columns: user_id, date, places, home
+                    in hours and routine_scale from 0 to 5.
+    :param by: other columns of features identifying the features of a day, e.g. parameters.
+    :return: dataframe with columns: by, user_id, date, feature, answer, value and error,
+             where error is value - answer.
+    """
+    by = list(by)
+    if 'datetime' not in features.columns:
+        raise ValueError('features need the datetime they were computed at, see feature_times')
+    df = features.merge(answers, on=['user_id', 'date'], suffixes=('', '_answer'))
+    # hours since midnight when the features were computed
+    elapsed = (pd.to_datetime(df['datetime']) - df['date']).dt.total_seconds() / SECONDS_PER_HOUR
+    home_stay = (elapsed - df.home) / elapsed
+    routine = df.routine_overlap if 'routine_overlap' in df.columns else 1 - df.routine_index
+    # feature --> (valid days, answer, value)
+    targets = {
+        'places': ((df.number_of_places > 0) & df.places.notna(),
+                   df.places, df.number_of_places),
+        'home_stay': ((df.home_stay >= 0) & (home_stay >= 0),
+                      home_stay, df.home_stay),
+        'routine': ((routine > -1) & (df.number_of_places > 0) & df.routine_scale.notna(),
+                    df.routine_scale / 5, routine),
+    }
+    frames = []
+    for feature, (valid, answer, value) in targets.items():
+        valid = valid.values
+        f = df.loc[valid, by + ['user_id', 'date']]
+        f['feature'] = feature
+        f['answer'] = answer.values[valid].astype(float)
+        f['value'] = value.values[valid].astype(float)
+        frames.append(f)
+    res = pd.concat(frames, ignore_index=True)
+    res['error'] = res.value - res.answer
+    return res
+
+
+def evaluate(features, answers, by=(), per_user=True):
+    """
+    Compute error metrics of features against answers.
+
+    :param features: dataframe of daily features, see errors.
+    :param answers: dataframe of answers, see errors.
+    :param by: other columns of features to group by, e.g. location_sweep.PARAMS.
+    :param per_user: compute metrics per user, otherwise over the days of all users.
+    :return: dataframe with a row per group of by, user and feature, with the number of
+             valid days n and the mean absolute error, root mean squared error, mean error
+             and minimum and maximum error of value - answer.
+    """
+    e = errors(features, answers, by)
+    keys = list(by) + (['user_id'] if per_user else []) + ['feature']
+    e['abs_error'] = e.error.abs()
+    e['squared_error'] = e.error ** 2
+    res = e.groupby(keys).agg(n=('error', 'size'), mae=('abs_error', 'mean'),
+                              rmse=('squared_error', 'mean'), me=('error', 'mean'),
+                              min=('error', 'min'), max=('error', 'max'))
+    res['rmse'] = np.sqrt(res.rmse)
+    return res.reset_index()[keys + METRICS]
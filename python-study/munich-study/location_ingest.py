@@ -0,0 +1,508 @@
+"""
+Asynchronous ingestion of uploaded location points.
+
+Points files uploaded by the study app, either written to an upload directory
+or sent to a local HTTP endpoint, are parsed concurrently and fed to the daily
+pipeline, so the features of a user are updated seconds after an upload:
+
+    python location_ingest.py uploads -o out --port 8080
+    curl -T points-2020-4-23_<user_id>.json localhost:8080/
+
+Uploads flow through bounded queues: upload --> parser --> pipeline worker.
+When the pipeline falls behind, full queues make the directory watcher and
+HTTP clients wait instead of buffering without limit. Every user is handled by
+one pipeline worker, which merges all batches queued for the user into one run.
+
+The service does not keep points in memory. The worker process of a run
+merges the new points into the days they fall on, stored with location_codec
+in <output>/points/user_id=<user_id>/<date>.ltrj, so only the touched days are
+rewritten and only the new points are sent to the worker. It then reads the
+history of the user and runs the pipeline. With max_history_days, a run only
+reads the days from max_history_days - 1 days before the first day with new
+points, which bounds the cost of a run, and its results only cover these days.
+Runs share a ResultCache, so only days with new points are recomputed.
+
+Results are partitioned by table and user like location_cli.py writes them,
+but stops, moves and features are written to one file per date,
+<output>/<table>/user_id=<user_id>/<date>.<format>, and a run only replaces
+the files of the days it covers. Places of a run are matched to the stored
+places table, so place labels stay the same across runs.
+"""
+
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from location import BACKENDS, haversine
+from location_cli import FORMATS, compute_user, normalize_points, read_partition, \
+    write_partition
+import location_codec
+
+
+MAX_UPLOAD_BYTES = 64 * 1024 * 1024
+POINTS_DIR = 'points'
+
+
+def parse_upload(name, data):
+    """
+    Parse an uploaded points file.
+
+    Files contain JSON lines or a JSON list of points. Points without a user_id
+    get the user id from the file name: points-<date>_<user_id>.json.
+
+    :param name: file name of the upload.
+    :param data: contents of the upload as bytes or str.
+    :return: dataframe of points as returned by normalize_points, None if there are no points.
+    """
+    text = data.decode('utf-8') if isinstance(data, bytes) else data
+    text = text.strip()
+    if text.startswith('['):
+        records = json.loads(text)
+    else:
+        records = []
+        for line in text.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue  # skip empty and partially written lines
+    df = pd.DataFrame(records)
+    if 'user_id' not in df.columns:
+        stem = os.path.splitext(os.path.basename(name))[0]
+        if '_' not in stem:
+            return None
+        df['user_id'] = stem.rsplit('_', 1)[1]
+    df = df.rename(columns={'lat': 'latitude', 'lon': 'longitude'})
+    if df.empty or not {'latitude', 'longitude'} <= set(df.columns):
+        return None
+    return normalize_points(df)
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def store_points(directory, user_id, points):
+    """
+    Merge new points of a user into the stored points of the days they fall on.
+
+    Points with the timestamp of a stored point replace it.
+
+    :param directory: directory of stored points.
+    :param user_id: id of the user.
+    :param points: dataframe of points as returned by normalize_points.
+    :return: list of dates with new points.
+    """
+    directory = os.path.join(directory, 'user_id=%s' % user_id)
+    os.makedirs(directory, exist_ok=True)
+    dates = pd.to_datetime(points.timestamp, unit='ms').dt.normalize()
+    for date, new in points.groupby(dates.values):
+        path = os.path.join(directory, '%s%s' % (pd.Timestamp(date).strftime('%Y-%m-%d'),
+                                                 location_codec.EXTENSION))
+        if os.path.exists(path):
+            new = pd.concat([location_codec.load(path), new], ignore_index=True)
+        new = new.drop_duplicates('timestamp', keep='last')
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        os.close(fd)
+        location_codec.save(new, tmp)
+        os.replace(tmp, path)
+    return sorted(pd.Timestamp(d) for d in dates.unique())
+
+
+def read_points(directory, user_id, start=None):
+    """
+    Read the stored points of a user.
+
+    :param directory: directory of stored points.
+    :param user_id: id of the user.
+    :param start: first date to read, or None for all days.
+    :return: dataframe of points sorted by time.
+    """
+    directory = os.path.join(directory, 'user_id=%s' % user_id)
+    names = sorted(f for f in os.listdir(directory) if f.endswith(location_codec.EXTENSION))
+    if start is not None:
+        first = pd.Timestamp(start).strftime('%Y-%m-%d')
+        names = [f for f in names if f[:10] >= first]
+    frames = [location_codec.load(os.path.join(directory, f)) for f in names]
+    df = pd.concat(frames, ignore_index=True)
+    df['user_id'] = user_id  # keep the type of the user id, the codec stores it as JSON
+    return df.sort_values('timestamp', kind='mergesort').reset_index(drop=True)
+
+
+def ingest_user(user_id, points, directory, max_history_days=None, *, output, fmt='csv',
+                **kwargs):
+    """
+    Store new points of a user, run the pipeline over the stored history and write the results.
+
+    Stops, moves and features are written to one file per date, and only the
+    files of the dates the run covers are replaced. Places keep the labels of
+    the stored places table, see _match_places, so labels of days outside the
+    run stay valid.
+
+    :param user_id: id of the user.
+    :param points: dataframe of new points of the user.
+    :param directory: directory of stored points.
+    :param max_history_days: the pipeline runs on the days from max_history_days - 1 days
+                             before the first day with new points, None for all stored days.
+    :param output: output directory.
+    :param fmt: output format, one of location_cli.FORMATS.
+    :param kwargs: arguments of location_cli.compute_user.
+    :return: dict with rows per table and profiler records.
+    """
+    dates = store_points(directory, user_id, points)
+    start = dates[0] - pd.Timedelta(days=max_history_days - 1) \
+        if max_history_days is not None else None
+    history = read_points(directory, user_id, start)
+    _, tables, records = compute_user(history, **kwargs)
+    dates = pd.to_datetime(history.timestamp, unit='ms').dt.normalize().unique()
+    names = [pd.Timestamp(d).strftime('%Y-%m-%d') for d in dates]
+
+    # stops of the covered dates written by earlier runs are replaced by this run
+    replaced = [read_partition(output, 'stops', user_id, fmt, name) for name in names]
+    replaced = pd.concat([df for df in replaced if df is not None] + [pd.DataFrame(
+        columns=['place', 'duration'])], ignore_index=True)
+    stored = read_partition(output, 'places', user_id, fmt)
+    labels = _match_places(stored, tables['places'], kwargs.get('place_dist', 25))
+    stops, moves = tables['stops'], tables['moves']
+    stops['place'] = stops.place.map(labels)
+    moves['from_place'] = moves.from_place.map(labels)
+    moves['to_place'] = moves.to_place.map(labels)
+    places = _update_places(stored, replaced, tables['places'], stops, labels)
+
+    rows = {'places': len(places)}
+    for table, df in [('stops', stops), ('moves', moves), ('features', tables['features'])]:
+        rows[table] = len(df)
+        for date, name in zip(dates, names):
+            day = df[df.date.values == date]
+            if len(day):
+                write_partition(day, output, table, user_id, fmt, name)
+            else:
+                _remove_partition(output, table, user_id, fmt, name)
+    write_partition(places, output, 'places', user_id, fmt)
+    return {'rows': rows, 'records': records}
+
+
+def _match_places(stored, places, dist):
+    """
+    Map place labels of a run to the labels of the stored places.
+
+    Places of the run get the label of the nearest stored place within dist
+    meters, pairs are matched from the nearest on so every stored label is
+    used once. Other places get labels after the largest stored label.
+    Distances are haversine distances, the precision of the distance function
+    of the run is not needed to tell places apart.
+
+    :param stored: stored places table, None if there is none.
+    :param places: places of the run.
+    :param dist: maximum distance between matched places in meters.
+    :return: dict from labels of the run to stable labels.
+    """
+    if stored is None or stored.empty:
+        return {p: p for p in places.place}
+    d = haversine(*np.broadcast_arrays(places.latitude.values[:, None],
+                                       places.longitude.values[:, None],
+                                       stored.latitude.values[None], stored.longitude.values[None]))
+    labels = {}
+    used = set()
+    for i, j in zip(*np.unravel_index(np.argsort(d, axis=None), d.shape)):
+        if d[i, j] > dist:
+            break
+        if places.place.values[i] not in labels and j not in used:
+            labels[places.place.values[i]] = stored.place.values[j]
+            used.add(j)
+    label = stored.place.max() + 1
+    for p in places.place:
+        if p not in labels:
+            labels[p] = label
+            label += 1
+    return labels
+
+
+def _update_places(stored, replaced, places, stops, labels):
+    """
+    Update the stored places table with the stops of a run.
+
+    Stored places keep their coordinates. Their duration and number of stops
+    are updated by the stops of the run replacing the stops of the same dates.
+    Places of the run without a stored place are added, places left without
+    stops are dropped.
+
+    :param stored: stored places table, None if there is none.
+    :param replaced: stored stops replaced by the run.
+    :param places: places of the run.
+    :param stops: stops of the run with stable labels.
+    :param labels: dict from labels of the run to stable labels.
+    :return: places table.
+    """
+    places = places.assign(place=places.place.map(labels)).set_index('place')
+    if stored is not None:
+        added = places[~places.index.isin(stored.place)].assign(duration=0.0, stops=0)
+        places = pd.concat([stored.set_index('place'), added])
+
+        def totals(df):
+            return df.groupby('place').duration.agg(['sum', 'count']).reindex(
+                places.index, fill_value=0)
+
+        new, old = totals(stops), totals(replaced)
+        places['duration'] += new['sum'] - old['sum']
+        places['stops'] += new['count'] - old['count']
+    return places[places.stops > 0].reset_index()[['user_id', 'place', 'latitude', 'longitude',
+                                                    'duration', 'stops']]
+
+
+def _remove_partition(output, table, user_id, fmt, name):
+    """Remove a table partition written by write_partition if it exists."""
+    path = os.path.join(output, table, 'user_id=%s' % user_id, '%s.%s' % (name, fmt))
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class IngestService:
+    """
+    Compute features from uploaded points as they arrive.
+
+    :param output: output directory of stops, places, moves and features.
+    :param upload_dir: directory watched for new and changed files, or None.
+    :param cache_dir: ResultCache directory, defaults to <output>/cache.
+    :param workers: number of pipeline workers, each runs in its own process.
+    :param parsers: number of concurrent parsers.
+    :param max_queue: maximum number of uploads or batches waiting in each queue.
+    :param poll_interval: seconds between scans of the upload directory.
+    :param max_history_days: number of days of stored points before and including the
+                             first day with new points each run uses, None for all days.
+    :param fmt: output format, one of location_cli.FORMATS.
+    :param distf: name of the distance function, 'geodesic', 'haversine' or 'local'.
+    :param executor: executor running the pipeline, defaults to a process pool.
+    :param params: parameters passed to get_stops_places_and_moves_daily.
+    """
+
+    def __init__(self, output, upload_dir=None, cache_dir=None, workers=2, parsers=2,
+                 max_queue=64, poll_interval=1.0, max_history_days=None, fmt='csv',
+                 distf='geodesic', min_samples_per_day=1, executor=None, **params):
+        assert workers > 0 and parsers > 0 and max_queue > 0
+        assert max_history_days is None or max_history_days > 0
+        self.output = output
+        self.upload_dir = upload_dir
+        self.workers = workers
+        self.parsers = parsers
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self.executor = executor
+        self.max_history_days = max_history_days
+        self.points_dir = os.path.join(output, POINTS_DIR)
+        self.run_kwargs = dict(params, output=output, fmt=fmt, distf=distf,
+                               min_samples_per_day=min_samples_per_day,
+                               cache_dir=cache_dir if cache_dir is not None
+                               else os.path.join(output, 'cache'))
+        self.stats = {'uploads': 0, 'skipped': 0, 'batches': 0, 'points': 0,
+                      'runs': 0, 'errors': 0}
+        # seconds from upload to written features of each run
+        self.latencies = []
+        self._tasks = []
+        self._server = None
+        self._owns_executor = False
+
+    async def start(self):
+        """Start the watcher, parsers and pipeline workers."""
+        os.makedirs(self.output, exist_ok=True)
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self._owns_executor = True
+        self._uploads = asyncio.Queue(self.max_queue)
+        self._batches = [asyncio.Queue(self.max_queue) for _ in range(self.workers)]
+        self._tasks = [asyncio.ensure_future(self._parse()) for _ in range(self.parsers)]
+        self._tasks += [asyncio.ensure_future(self._work(q)) for q in self._batches]
+        if self.upload_dir is not None:
+            os.makedirs(self.upload_dir, exist_ok=True)
+            self._tasks.append(asyncio.ensure_future(self._watch()))
+
+    async def serve_http(self, host='127.0.0.1', port=8080):
+        """
+        Accept uploads over HTTP.
+
+        PUT or POST /<file name> queues the body as an upload and answers
+        202 Accepted, GET /stats returns the service statistics as JSON.
+        """
+        self._server = await asyncio.start_server(self._handle_http, host, port)
+        return self._server
+
+    async def submit(self, name, data):
+        """
+        Queue an upload, waiting while the upload queue is full.
+
+        :param name: file name of the upload.
+        :param data: contents as bytes, or None to read the file at name.
+        """
+        await self._uploads.put((name, data, time.time()))
+
+    async def join(self):
+        """Wait until all queued uploads are parsed and their features are written."""
+        await self._uploads.join()
+        for q in self._batches:
+            await q.join()
+
+    async def stop(self):
+        """Stop all tasks and the HTTP server."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._owns_executor:
+            self.executor.shutdown()
+            self.executor = None
+
+    async def _watch(self):
+        """Queue files in the upload directory that are new or changed since the last scan."""
+        seen = {}
+        while True:
+            for entry in os.scandir(self.upload_dir):
+                if entry.name.startswith('.') or entry.name.endswith('.tmp') \
+                        or not entry.is_file():
+                    continue
+                st = entry.stat()
+                if seen.get(entry.name) != (st.st_mtime_ns, st.st_size):
+                    seen[entry.name] = (st.st_mtime_ns, st.st_size)
+                    await self.submit(entry.path, None)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _parse(self):
+        """Parse uploads and queue the points of each user to its pipeline worker."""
+        loop = asyncio.get_event_loop()
+        while True:
+            name, data, received = await self._uploads.get()
+            try:
+                if data is None:
+                    data = await loop.run_in_executor(None, _read_file, name)
+                df = await loop.run_in_executor(None, parse_upload, name, data)
+                self.stats['uploads'] += 1
+                if df is None:
+                    self.stats['skipped'] += 1
+                    continue
+                for user_id, points in df.groupby('user_id', sort=False):
+                    await self._batches[hash(str(user_id)) % self.workers].put(
+                        (user_id, points, received))
+            except Exception as e:
+                self.stats['errors'] += 1
+                print('%s: %s: %s' % (name, type(e).__name__, e), file=sys.stderr)
+            finally:
+                self._uploads.task_done()
+
+    async def _work(self, queue):
+        """Run the pipeline for users with new points, one run per user for all queued batches."""
+        loop = asyncio.get_event_loop()
+        while True:
+            batches = [await queue.get()]
+            while not queue.empty():
+                batches.append(queue.get_nowait())
+            # new points and time of the first upload of each user
+            received = {}
+            for user_id, points, t in batches:
+                self.stats['batches'] += 1
+                self.stats['points'] += len(points)
+                if user_id in received:
+                    points = pd.concat([received[user_id][0], points], ignore_index=True)
+                    t = min(t, received[user_id][1])
+                received[user_id] = (points, t)
+            for user_id, (points, t) in received.items():
+                try:
+                    await loop.run_in_executor(
+                        self.executor, partial(ingest_user, user_id, points, self.points_dir,
+                                               self.max_history_days, **self.run_kwargs))
+                    self.stats['runs'] += 1
+                    self.latencies.append(time.time() - t)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    print('%s: %s: %s' % (user_id, type(e).__name__, e), file=sys.stderr)
+            for _ in batches:
+                queue.task_done()
+
+    async def _handle_http(self, reader, writer):
+        body = b''
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            path = unquote(urlsplit(target).path)
+            length = int(headers.get('content-length', 0))
+            if method == 'GET' and path == '/stats':
+                status, body = '200 OK', json.dumps(self.stats).encode('utf-8')
+            elif method not in ('PUT', 'POST'):
+                status = '405 Method Not Allowed'
+            elif length > MAX_UPLOAD_BYTES:
+                status = '413 Payload Too Large'
+            elif not os.path.basename(path):
+                status = '400 Bad Request'
+            else:
+                data = await reader.readexactly(length)
+                await self.submit(os.path.basename(path), data)
+                status = '202 Accepted'
+        except (ValueError, asyncio.IncompleteReadError):
+            status = '400 Bad Request'
+        writer.write(('HTTP/1.1 %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                      % (status, len(body))).encode('latin-1') + body)
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+
+
+async def _serve(args):
+    service = IngestService(args.output, args.upload_dir, args.cache, args.workers,
+                            args.parsers, args.max_queue, args.poll_interval,
+                            args.max_history_days, args.format, args.distf,
+                            backend=args.backend)
+    await service.start()
+    if args.port is not None:
+        await service.serve_http(args.host, args.port)
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(json.dumps(service.stats), file=sys.stderr)
+    finally:
+        await service.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute features from uploaded location points.')
+    parser.add_argument('upload_dir', nargs='?', help='directory watched for points files')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, help='accept uploads over HTTP on this port')
+    parser.add_argument('--cache', metavar='DIR', help='ResultCache directory')
+    parser.add_argument('--workers', type=int, default=2, help='pipeline worker processes')
+    parser.add_argument('--parsers', type=int, default=2)
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='seconds')
+    parser.add_argument('--max-history-days', type=int,
+                        help='days of stored points each run uses, all days by default')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--distf', choices=['geodesic', 'haversine', 'local'], default='geodesic')
+    parser.add_argument('--backend', choices=BACKENDS, default='numpy',
+                        help='backend of the distance_grouping kernel')
+    args = parser.parse_args(argv)
+    if args.upload_dir is None and args.port is None:
+        parser.error('give an upload directory, --port or both')
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""
+Bulk download of study data from object storage.
+
+The study app uploads one points file per user and day, named
+points-<year>-<month>-<day>_<user_id>.json, and one file per user for stops,
+moves, features and answers. Files are downloaded concurrently over a pooled
+HTTP session with retries, and stored in a local cache partitioned by user:
+
+    <directory>/user_id=<user_id>/<file name>
+
+Along with each file its ETag and Last-Modified headers are stored, so files
+already in the cache are requested conditionally and unchanged files are not
+downloaded again:
+
+    python location_download.py <user_id> ... -d study_data --start 2020-04-23 --days 30
+
+base_url can point to any server with the same layout, e.g. a local
+http.server serving a copy of the bucket.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+STORAGE_URL = 'https://firebasestorage.googleapis.com/v0/b/mobilityfeatures.appspot.com/o/'
+
+# file types
+ANSWERS = 'answers'
+POINTS = 'points'
+STOPS = 'stops'
+MOVES = 'moves'
+FEATURES = 'features'
+
+META_SUFFIX = '.meta.json'
+
+
+def file_name(user_id, file_type, date=None):
+    """
+    Name of a file in storage.
+
+    :param user_id: id of the user.
+    :param file_type: one of ANSWERS, POINTS, STOPS, MOVES and FEATURES.
+    :param date: date of a points file.
+    :return: file name.
+    """
+    if file_type == POINTS:
+        date = pd.Timestamp(date)
+        return '%s-%d-%d-%d_%s.json' % (POINTS, date.year, date.month, date.day, user_id)
+    return '%s_%s.json' % (file_type, user_id)
+
+
+class Downloader:
+    """
+    Concurrent downloader of study files with a local cache.
+
+    :param directory: cache directory.
+    :param base_url: URL of the storage bucket, files are at <base_url><user_id>%2F<file name>.
+    :param token: optional access token added to every request.
+    :param max_workers: number of concurrent downloads and pooled connections.
+    :param retries: number of retries of failed connections and 429 or 5xx responses.
+    :param backoff: backoff factor in seconds between retries.
+    :param timeout: seconds to wait for the server.
+    """
+
+    def __init__(self, directory, base_url=STORAGE_URL, token=None, max_workers=8, retries=3,
+                 backoff=0.5, timeout=30):
+        self.directory = directory
+        self.base_url = base_url
+        self.token = token
+        self.max_workers = max_workers
+        self.timeout = timeout
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'],
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def url(self, user_id, name):
+        """URL of a file in storage."""
+        url = self.base_url + quote('%s/%s' % (user_id, name), safe='') + '?alt=media'
+        if self.token is not None:
+            url += '&token=' + self.token
+        return url
+
+    def path(self, user_id, name):
+        """Path of a file in the cache."""
+        return os.path.join(self.directory, 'user_id=%s' % user_id, name)
+
+    def fetch(self, user_id, name):
+        """
+        Download one file unless the cached copy is up to date.
+
+        :param user_id: id of the user.
+        :param name: file name.
+        :return: dict with user_id, name, status, bytes and seconds. The status is
+                 'downloaded', 'not_modified', 'missing' or 'error: <reason>'.
+        """
+        start = time.perf_counter()
+        path = self.path(user_id, name)
+        meta = _read_meta(path)
+        headers = {}
+        if 'etag' in meta:
+            headers['If-None-Match'] = meta['etag']
+        if 'last_modified' in meta:
+            headers['If-Modified-Since'] = meta['last_modified']
+        size = 0
+        try:
+            r = self.session.get(self.url(user_id, name), headers=headers, timeout=self.timeout)
+            if r.status_code == 304:
+                status = 'not_modified'
+            elif r.status_code == 404:
+                status = 'missing'
+            elif r.ok:
+                _write(path, r.content)
+                _write(path + META_SUFFIX, json.dumps({
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                }).encode('utf-8'))
+                status, size = 'downloaded', len(r.content)
+            else:
+                status = 'error: HTTP %d' % r.status_code
+        except requests.RequestException as e:
+            status = 'error: %s' % type(e).__name__
+        return {'user_id': user_id, 'name': name, 'status': status, 'bytes': size,
+                'seconds': time.perf_counter() - start}
+
+    def download(self, user_ids, start=None, days=0, file_types=(POINTS,)):
+        """
+        Download the files of many users concurrently.
+
+        :param user_ids: list of user ids.
+        :param start: first date of points files, required if days > 0.
+        :param days: number of days of points files from start.
+        :param file_types: file types to download, points files are downloaded for each day.
+        :return: dataframe with a row per file as returned by fetch.
+        """
+        if days and start is None:
+            raise ValueError('start is required to download %d days of points files' % days)
+        dates = pd.date_range(start, periods=days) if days else []
+        names = [(u, file_name(u, t, d)) for u in user_ids for t in file_types
+                 for d in (dates if t == POINTS else [None])]
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            results = list(executor.map(lambda a: self.fetch(*a), names))
+        return pd.DataFrame(results, columns=['user_id', 'name', 'status', 'bytes', 'seconds'])
+
+    def read(self, user_id, file_type=POINTS):
+        """
+        Read cached files of a user.
+
+        Files contain one JSON object per line, lines that are not valid JSON are skipped.
+
+        :param user_id: id of the user.
+        :param file_type: file type to read, points of all cached days are combined.
+        :return: dataframe with a row per JSON object.
+        """
+        directory = os.path.dirname(self.path(user_id, ''))
+        prefix = file_type + ('-' if file_type == POINTS else '_')
+        records = []
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.startswith(prefix) and not name.endswith(META_SUFFIX):
+                    with open(os.path.join(directory, name)) as f:
+                        for line in f:
+                            try:
+                                records.append(json.loads(line))
+                            except ValueError:
+                                continue
+        return pd.DataFrame(records)
+
+
+def _read_meta(path):
+    """Cache headers of a cached file, empty if the file is not cached."""
+    if not os.path.exists(path) or not os.path.exists(path + META_SUFFIX):
+        return {}
+    with open(path + META_SUFFIX) as f:
+        return {k: v for k, v in json.load(f).items() if v is not None}
+
+
+def _write(path, data):
+    """Write a file atomically."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # a unique temporary file, concurrent writers of the same path do not share it
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Download study data from object storage.')
+    parser.add_argument('user_ids', nargs='+')
+    parser.add_argument('-d', '--directory', default='study_data', help='cache directory')
+    parser.add_argument('--base-url', default=STORAGE_URL)
+    parser.add_argument('--token', default=os.environ.get('STORAGE_TOKEN'),
+                        help='access token, defaults to $STORAGE_TOKEN')
+    parser.add_argument('--start', default='2020-04-23', help='first date of points files')
+    parser.add_argument('--days', type=int, default=30, help='number of days of points files')
+    parser.add_argument('--types', nargs='+', default=[POINTS, STOPS, MOVES, FEATURES, ANSWERS],
+                        choices=[POINTS, STOPS, MOVES, FEATURES, ANSWERS])
+    parser.add_argument('-j', '--jobs', type=int, default=8, help='concurrent downloads')
+    parser.add_argument('--retries', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    with Downloader(args.directory, args.base_url, args.token, args.jobs, args.retries) as d:
+        res = d.download(args.user_ids, args.start, args.days, args.types)
+    print(res.groupby('status').agg({'name': 'count', 'bytes': 'sum'})
+             .rename(columns={'name': 'files'}).to_string(), file=sys.stderr)
+    if res.status.str.startswith('error').any():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""
+On-disk trajectory store for location data.
+
+Location points are stored column-wise as NumPy files, sorted by user and
+time, together with an index of (user_id, date) --> row offsets. Columns are
+opened memory-mapped, so loading the points of one user-day is a slice of the
+mapped arrays and no data is read from disk until it is used.
+
+Layout of a store directory:
+
+- index.csv: one row per user-day with columns user_id, date, start, stop.
+- <column>.npy: one file per stored column, e.g. timestamp, datetime,
+  latitude and longitude.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+INDEX_FILE = 'index.csv'
+DEFAULT_COLUMNS = ['timestamp', 'datetime', 'latitude', 'longitude']
+
+
+def write_store(df, path, columns=DEFAULT_COLUMNS):
+    """
+    Write location points to a trajectory store.
+
+    :param df: dataframe of preprocessed location points with columns:
+               user_id, datetime, date and the columns to store.
+    :param path: directory of the store, created if it does not exist.
+    :param columns: list of numeric or datetime columns to store.
+    :return: dataframe of the store index.
+    """
+    required_columns = ['user_id', 'datetime', 'date'] + list(columns)
+    # validate input
+    assert all(c in df.columns for c in required_columns)
+    # sort points by user and time so each user-day is a contiguous range
+    df = df.sort_values(['user_id', 'datetime'], kind='mergesort')
+    os.makedirs(path, exist_ok=True)
+    for c in columns:
+        np.save(os.path.join(path, c + '.npy'), np.ascontiguousarray(df[c].values))
+    # create index of row offsets per user-day
+    sizes = df.groupby(['user_id', 'date'], sort=False).size()
+    index = sizes.reset_index(name='stop')
+    index['stop'] = np.cumsum(index['stop'].values)
+    index.insert(2, 'start', index['stop'] - sizes.values)
+    index.to_csv(os.path.join(path, INDEX_FILE), index=False)
+    return index
+
+
+class TrajectoryStore:
+    """
+    Read-only view of a trajectory store written with write_store.
+
+    :param path: directory of the store.
+    :param mmap_mode: mode passed to numpy.load, 'r' maps columns read-only.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        # user ids are read as strings so lookups do not depend on inferred types
+        self.index = pd.read_csv(os.path.join(path, INDEX_FILE), parse_dates=['date'],
+                                 dtype={'user_id': str})
+        self.columns = {}
+        for f in sorted(os.listdir(path)):
+            if f.endswith('.npy'):
+                self.columns[f[:-4]] = np.load(os.path.join(path, f), mmap_mode=mmap_mode)
+        # (user_id, date) --> (start, stop)
+        self._offsets = {
+            (u, d): (start, stop) for u, d, start, stop in zip(
+                self.index.user_id.values, self.index.date.values,
+                self.index.start.values, self.index.stop.values)
+        }
+        # user_id --> (start, stop), users are contiguous in the store
+        users = self.index.groupby('user_id', sort=False).agg({'start': 'min', 'stop': 'max'})
+        self._user_offsets = dict(zip(users.index.values,
+                                      zip(users.start.values, users.stop.values)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def users(self):
+        """Return the user ids in the store as strings."""
+        return list(self._user_offsets)
+
+    def dates(self, user_id):
+        """Return the dates with points for a user."""
+        return self.index.date[self.index.user_id == str(user_id)].values
+
+    def offsets(self, user_id, date=None):
+        """
+        Get the row range of a user or a user-day.
+
+        :param user_id: id of the user.
+        :param date: date of the user-day, or None for all days of the user.
+        :return: tuple (start, stop), (0, 0) if there are no points.
+        """
+        if date is None:
+            return self._user_offsets.get(str(user_id), (0, 0))
+        return self._offsets.get((str(user_id), np.datetime64(date, 'ns')), (0, 0))
+
+    def arrays(self, user_id, date=None):
+        """
+        Get the stored columns of a user or a user-day without copying.
+
+        :param user_id: id of the user.
+        :param date: date of the user-day, or None for all days of the user.
+        :return: dict of column name --> memory-mapped array slice.
+        """
+        start, stop = self.offsets(user_id, date)
+        return {c: a[start:stop] for c, a in self.columns.items()}
+
+    def points(self, user_id, date=None):
+        """
+        Load points of a user or a user-day as a dataframe.
+
+        The dataframe can be passed directly to get_stops_places_and_moves_daily.
+
+        :param user_id: id of the user.
+        :param date: date of the user-day, or None for all days of the user.
+        :return: dataframe of location points.
+        """
+        df = pd.DataFrame(self.arrays(user_id, date))
+        df.insert(0, 'user_id', user_id)
+        if 'datetime' in df.columns:
+            df['date'] = df['datetime'].dt.normalize()
+        return df
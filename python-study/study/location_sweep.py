@@ -0,0 +1,179 @@
+"""
+Parameter sweeps of the stops, places and moves pipeline.
+
+Tuning the pipeline against participant answers, such as the number of places
+or home stay, means running it for every combination of a parameter grid. Most
+combinations share the results of earlier stages: stops only depend on the
+stop and merge parameters, places also on place_dist, and moves also on the
+move parameters. A sweep plans the grid as a tree and runs every stage once
+per distinct combination of the parameters it depends on:
+
+    stops   stop_algorithm, stop_duration, stop_dist, merge, merge_dist, merge_time
+    places  place_dist
+    moves   move_duration, move_dist
+
+Daily features that only depend on stops and places are computed once per
+places result, and the move features once per moves result. Users and
+combinations of stop parameters are run in worker processes reading the
+points from location.SharedPoints:
+
+    grid = {'stop_dist': [15, 25, 50], 'place_dist': [25, 50], 'move_duration': [3, 5]}
+    results = sweep(preprocess(df), grid, n_jobs=4)
+    results.groupby(list(grid)).home_stay.mean()
+
+The results have a row per combination, user and day with the parameters, the
+daily features and the datetime of the features, the departure of the last
+stop of the day, and can be scored against answers with location_eval.evaluate.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import inspect
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import location
+
+
+# parameters of each stage in pipeline order,
+# a stage also depends on the parameters of earlier stages
+STAGES = [
+    ('stops', ['stop_algorithm', 'stop_duration', 'stop_dist', 'merge', 'merge_dist',
+               'merge_time']),
+    ('places', ['place_dist']),
+    ('moves', ['move_duration', 'move_dist']),
+]
+PARAMS = [p for _, params in STAGES for p in params]
+DEFAULTS = {name: p.default for name, p in
+            inspect.signature(location.get_stops_places_and_moves_daily).parameters.items()
+            if name in PARAMS}
+
+
+def combinations(grid):
+    """
+    All parameter combinations of a grid.
+
+    :param grid: dict of parameter in PARAMS --> list of values, or a single value.
+                 Parameters not in the grid have their default value.
+    :return: list of dicts with a value for every parameter in PARAMS.
+    """
+    unknown = set(grid) - set(PARAMS)
+    if unknown:
+        raise ValueError('unknown parameters: %s' % ', '.join(sorted(unknown)))
+    values = [grid.get(p, DEFAULTS[p]) for p in PARAMS]
+    values = [[v] if np.ndim(v) == 0 else list(v) for v in values]
+    return [dict(zip(PARAMS, c)) for c in itertools.product(*values)]
+
+
+def plan(grid):
+    """
+    Plan the stages of a grid so combinations share the results of earlier stages.
+
+    :param grid: dict of parameter --> list of values, see combinations.
+    :return: dict of stops parameters --> dict of places parameters --> list of moves
+             parameters, where the parameters of a stage are a tuple in the order of STAGES.
+    """
+    tree = {}
+    for c in combinations(grid):
+        stops, places, moves = [tuple(c[p] for p in params) for _, params in STAGES]
+        branch = tree.setdefault(stops, {}).setdefault(places, [])
+        if moves not in branch:
+            branch.append(moves)
+    return tree
+
+
+def stage_runs(grid):
+    """
+    Number of runs of each stage for one user, with and without sharing results.
+
+    :param grid: dict of parameter --> list of values, see combinations.
+    :return: dataframe with stage, runs and runs without a plan.
+    """
+    tree = plan(grid)
+    runs = [len(tree),
+            sum(len(places) for places in tree.values()),
+            sum(len(moves) for places in tree.values() for moves in places.values())]
+    return pd.DataFrame({'stage': [stage for stage, _ in STAGES], 'runs': runs,
+                         'unplanned_runs': len(combinations(grid))})
+
+
+def sweep(df, grid, distf=location.haversine_distance, n_jobs=1, backend='numpy'):
+    """
+    Compute daily features for every combination of a parameter grid.
+
+    :param df: dataframe of preprocessed location points of one or more users.
+    :param grid: dict of parameter --> list of values, see combinations.
+    :param distf: distance function of the form: ((lat, lon),(lat, lon)) --> (distance in meters),
+                  or 'local'. With n_jobs > 1 and processes that are not forked it is pickled.
+    :param n_jobs: number of worker processes, each computes the stops of a user for one
+                   combination of stop parameters and all places, moves and features using them.
+    :param backend: backend of the grouping kernel of the distance_grouping algorithm,
+                    one of location.BACKENDS.
+    :return: dataframe with the parameters in PARAMS, the columns of
+             location.get_daily_features and the datetime of the features, see
+             location_eval.feature_times, for each combination, user and day.
+    """
+    tree = plan(grid)
+    df = df.sort_values(['user_id', 'datetime'], kind='mergesort')
+    tasks = [(user_id, stops) for user_id in df.user_id.unique().tolist() for stops in tree]
+    if n_jobs > 1 and len(tasks) > 1:
+        points = location.SharedPoints.publish(df)
+        state = {'tree': tree, 'distf': distf, 'backend': backend}
+        try:
+            with ProcessPoolExecutor(min(n_jobs, len(tasks)), initializer=location._init_worker,
+                                     initargs=(points.spec, state)) as executor:
+                frames = list(executor.map(_run_shared_branch, tasks))
+        finally:
+            points.close()
+    else:
+        users = {user_id: points for user_id, points in df.groupby('user_id', sort=False)}
+        frames = [_run_branch(users[user_id], stops, tree[stops], distf, backend)
+                  for user_id, stops in tasks]
+    results = pd.concat(frames, ignore_index=True)
+    return results.sort_values(PARAMS + ['user_id', 'date'], kind='mergesort') \
+                  .reset_index(drop=True)
+
+
+def _run_shared_branch(task):
+    """Run _run_branch for a user of the shared points of a worker process."""
+    user_id, stops = task
+    w = location._WORKER
+    return _run_branch(w['points'].user_frame(user_id), stops, w['tree'][stops], w['distf'],
+                       w['backend'])
+
+
+def _run_branch(df, stops_params, places_params, distf, backend='numpy'):
+    """
+    Compute stops of one user for one combination of stop parameters, and everything using them.
+
+    :param df: dataframe of preprocessed location points of one user sorted chronologically.
+    :param stops_params: tuple of stops parameters.
+    :param places_params: dict of places parameters --> list of moves parameters.
+    :param backend: backend of location.get_stops.
+    :return: dataframe of parameters and daily features of each combination in the branch.
+    """
+    points = df.rename(columns={'latitude': 'lat', 'longitude': 'lon'})
+    distf = location._resolve_distance(distf, points)
+    kwargs = dict(zip(STAGES[0][1], stops_params))
+    stops = location._get_daily_stops(points, kwargs['stop_duration'], kwargs['stop_dist'],
+                                      kwargs['merge'], kwargs['merge_dist'],
+                                      kwargs['merge_time'], distf, kwargs['stop_algorithm'],
+                                      backend=backend)
+    frames = []
+    for places_key, moves_params in places_params.items():
+        place_dist, = places_key
+        # get_places labels the stops it is given
+        labeled, _ = location._get_places_stage(stops.copy(), place_dist, distf)
+        features = location._stop_features(df, location._result_columns(labeled), distf)
+        # home stay is computed until the departure of the last stop of the day
+        times = labeled.groupby('date').departure.max() if len(labeled) else {}
+        features.insert(2, 'datetime', features.date.map(times))
+        for moves_key in moves_params:
+            move_duration, move_dist = moves_key
+            moves = location._get_daily_moves(points, labeled, move_duration, move_dist, distf)
+            res = location._add_move_features(features, location._result_columns(moves))
+            for i, (p, v) in enumerate(zip(PARAMS, stops_params + places_key + moves_key)):
+                res.insert(i, p, v)
+            frames.append(res)
+    return pd.concat(frames, ignore_index=True)